@@ -0,0 +1,221 @@
+import asyncio
+import time
+from collections import deque
+
+
+def parse_model_limits(value, default_limits):
+    """Parses "gpt-4o-mini=500,gpt-4o=100" into a dict of limits per model."""
+    limits = dict(default_limits)
+
+    if not value:
+        return limits
+
+    for item in value.split(","):
+        model, limit = item.split("=")
+        limits[model.strip()] = int(limit)
+
+    return limits
+
+
+class TokenBucket():
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        self.refill()
+
+        # a request larger than the bucket could never pass, so it only needs a full bucket
+        tokens = min(tokens, self.capacity)
+
+        if self.tokens < tokens:
+            return False
+
+        self.tokens -= tokens
+
+        return True
+
+    def time_until_available(self, tokens=1):
+        self.refill()
+
+        tokens = min(tokens, self.capacity)
+
+        return max(0, (tokens - self.tokens) / self.rate)
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionTicket():
+    def __init__(self, controller, model):
+        self.controller = controller
+        self.model = model
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.model)
+
+
+class AdmissionController():
+    """Decides whether a model request may run now, has to wait in a queue or is rejected.
+
+    Every user has a token bucket per model. Every model has request and token per minute
+    buckets that follow the OpenAI limits and a cap on concurrent requests. Requests over
+    the model limits wait in a bounded FIFO queue for at most max_wait seconds.
+    """
+
+    def __init__(self, user_rate_per_minute=10, user_burst=3, model_rpm_limits=None, model_tpm_limits=None,
+                 max_concurrency=20, max_queue_size=100, max_wait=30):
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = user_burst
+        self.model_rpm_limits = model_rpm_limits or {}
+        self.model_tpm_limits = model_tpm_limits or {}
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait
+        self.user_buckets = {}
+        self.model_buckets = {}
+        self.active_requests = {}
+        self.queues = {}
+        self.admitted = {}
+        self.rejections = {}
+
+    def get_user_bucket(self, user_id, model):
+        key = (user_id, model)
+
+        if key not in self.user_buckets:
+            # drop buckets that are full again, they behave like new ones
+            if len(self.user_buckets) > 100000:
+                self.prune_user_buckets()
+
+            self.user_buckets[key] = TokenBucket(self.user_rate, self.user_burst)
+
+        return self.user_buckets[key]
+
+    def prune_user_buckets(self):
+        for key, bucket in list(self.user_buckets.items()):
+            bucket.refill()
+
+            if bucket.tokens >= bucket.capacity:
+                self.user_buckets.pop(key)
+
+    def get_model_buckets(self, model):
+        if model not in self.model_buckets:
+            buckets = []
+
+            if model in self.model_rpm_limits:
+                limit = self.model_rpm_limits[model]
+                buckets.append(("requests", TokenBucket(limit / 60, limit)))
+
+            if model in self.model_tpm_limits:
+                limit = self.model_tpm_limits[model]
+                buckets.append(("tokens", TokenBucket(limit / 60, limit)))
+
+            self.model_buckets[model] = buckets
+
+        return self.model_buckets[model]
+
+    def reject(self, model, reason):
+        self.rejections[(model, reason)] = self.rejections.get((model, reason), 0) + 1
+
+        raise AdmissionRejected(reason)
+
+    async def admit(self, user_id, model, tokens=1, on_queued=None):
+        if not self.get_user_bucket(user_id, model).try_acquire():
+            self.reject(model, "user_rate_limit")
+
+        deadline = time.monotonic() + self.max_wait
+
+        await self.acquire_slot(model, deadline, on_queued)
+
+        try:
+            await self.wait_for_model_budget(model, tokens, deadline)
+        except AdmissionRejected:
+            self.release(model)
+
+            raise
+
+        self.admitted[model] = self.admitted.get(model, 0) + 1
+
+        return AdmissionTicket(self, model)
+
+    async def acquire_slot(self, model, deadline, on_queued):
+        queue = self.queues.setdefault(model, deque())
+
+        if self.active_requests.get(model, 0) < self.max_concurrency and len(queue) == 0:
+            self.active_requests[model] = self.active_requests.get(model, 0) + 1
+
+            return
+
+        if len(queue) >= self.max_queue_size:
+            self.reject(model, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+
+        if on_queued:
+            try:
+                await on_queued(len(queue))
+            except Exception as ex:
+                print(ex)
+
+        try:
+            # release() hands the slot over by resolving the future
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=max(0, deadline - time.monotonic()))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as ex:
+            if waiter.done():
+                self.release(model)
+            else:
+                waiter.cancel()
+                queue.remove(waiter)
+
+            if isinstance(ex, asyncio.CancelledError):
+                raise
+
+            self.reject(model, "queue_timeout")
+
+    async def wait_for_model_budget(self, model, tokens, deadline):
+        for name, bucket in self.get_model_buckets(model):
+            amount = tokens if name == "tokens" else 1
+
+            while not bucket.try_acquire(amount):
+                delay = bucket.time_until_available(amount)
+
+                if time.monotonic() + delay > deadline:
+                    self.reject(model, "{}_budget".format(name))
+
+                await asyncio.sleep(delay)
+
+    def release(self, model):
+        queue = self.queues.get(model)
+
+        while queue:
+            waiter = queue.popleft()
+
+            if not waiter.done():
+                waiter.set_result(True)
+
+                return
+
+        self.active_requests[model] -= 1
+
+    def get_stats(self):
+        return {
+            "queue_depth": {model: len(queue) for model, queue in self.queues.items()},
+            "active_requests": dict(self.active_requests),
+            "admitted": dict(self.admitted),
+            "rejections": {"{}:{}".format(model, reason): count for (model, reason), count in self.rejections.items()}
+        }
@@ -0,0 +1,1494 @@
+import argparse
+import asyncio
+import os
+import collections
+import logging
+import concurrent.futures
+from copy import deepcopy
+import json
+import aiohttp
+from aiohttp import web
+import math
+import random
+import statistics
+import time
+import tracemalloc
+import resource
+import subprocess
+import sys
+from openai import AsyncOpenAI
+from datetime import datetime, date, timedelta
+from telegram import Update, Message, Chat, User
+from telegram.ext import TypeHandler
+from update_processor import PerUserUpdateProcessor
+from pymongo import MongoClient
+from quota import QuotaEngine
+from mongodb_persistence import MongoDBPersistence, create_user_indexes, USER_PROJECTION
+from model_client import ModelClient, FakeModelBackend, create_model_client
+from resilience import RetryPolicy, CircuitOpenError
+from user_state import UserState, UNLIMITED
+from streaming import StreamingMessageEditor
+from webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+
+def create_synthetic_update(update_id, user_id, text):
+    user = User(id=user_id, first_name="user{}".format(user_id), is_bot=False)
+
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=user_id, type="private"),
+        from_user=user,
+        text=text
+    )
+
+    return Update(update_id=update_id, message=message)
+
+
+class LatencyDistribution():
+    """Latency in seconds given as "0.05" (fixed), "uniform:0.02,0.2" or "lognormal:0.3,0.6" (median and sigma)."""
+
+    def __init__(self, spec):
+        kind, _, parameters = str(spec).rpartition(":")
+        self.kind = kind or "fixed"
+        self.parameters = [float(value) for value in parameters.split(",")]
+
+        if self.kind not in ["fixed", "uniform", "lognormal"]:
+            raise ValueError("Unknown latency distribution: {}".format(spec))
+
+    def sample(self):
+        if self.kind == "uniform":
+            return random.uniform(*self.parameters)
+
+        if self.kind == "lognormal":
+            median, sigma = self.parameters
+
+            return random.lognormvariate(math.log(median), sigma)
+
+        return self.parameters[0]
+
+
+def sample_latency(latency):
+    return latency.sample() if isinstance(latency, LatencyDistribution) else latency
+
+
+class FakeMessage():
+    def __init__(self, bot, chat_id, text):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.text = text
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot.call("edit_message_text")
+
+        self.text = text
+
+
+class FakeBot():
+    """Records Bot API calls and answers them after a fixed latency."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = {}
+
+    async def call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.call("send_message")
+
+        return FakeMessage(self, chat_id, text)
+
+
+class FakeTelegramServer():
+    """Local stand-in for the Telegram Bot API that records the answers sent to every chat."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = {}
+        self.message_id = 0
+        self.started_chats = set()
+        self.pending_requests = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.web_application = web.Application()
+        self.web_application.router.add_post("/bot{token}/{method}", self.handle_call)
+
+    def expect_answer(self, chat_id):
+        self.pending_requests[chat_id].append(time.perf_counter())
+
+    def record_message(self, chat_id, text):
+        if text == "Обрабатываю запрос...":
+            self.started_chats.add(chat_id)
+        elif text and text.startswith("Вы в очереди"):
+            return
+        elif chat_id in self.started_chats and len(self.pending_requests[chat_id]) > 0:
+            self.started_chats.discard(chat_id)
+            self.latencies.append(time.perf_counter() - self.pending_requests[chat_id].popleft())
+
+    async def handle_call(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        await asyncio.sleep(sample_latency(self.latency))
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ["sendMessage", "sendDocument", "sendInvoice", "editMessageText"]:
+            chat_id = int(data.get("chat_id", 0))
+
+            self.message_id += 1
+            self.record_message(chat_id, data.get("text"))
+
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", "")
+            }
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port):
+        self.runner = web.AppRunner(self.web_application)
+
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeOpenAIServer():
+    """Local OpenAI compatible chat completions API that injects failures.
+
+    Every request fails with one of failure_statuses with probability failure_rate, the
+    first fail_first requests always fail, and models in down_models always answer 503,
+    like every request while down is set. With a rate_limit of requests per rate_window
+    seconds it sends x-ratelimit headers and answers 429 once the limit is used up.
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, failure_statuses=(429, 500, 503), retry_after=None, fail_first=0,
+                 rate_limit=None, rate_window=60):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_statuses = failure_statuses
+        self.retry_after = retry_after
+        self.fail_first = fail_first
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.request_times = collections.deque()
+        self.down = False
+        self.down_models = set()
+        self.requests = {}
+        self.web_application = web.Application()
+        self.web_application.router.add_post("/v1/chat/completions", self.handle_chat_completion)
+        self.web_application.router.add_get("/v1/models", self.handle_models)
+
+    def get_rate_limit_headers(self):
+        if self.rate_limit is None:
+            return {}
+
+        now = time.monotonic()
+
+        while self.request_times and self.request_times[0] <= now - self.rate_window:
+            self.request_times.popleft()
+
+        reset = self.request_times[0] + self.rate_window - now if self.request_times else 0
+
+        return {
+            "x-ratelimit-limit-requests": str(self.rate_limit),
+            "x-ratelimit-remaining-requests": str(max(0, self.rate_limit - len(self.request_times))),
+            "x-ratelimit-reset-requests": "{:.3f}s".format(reset)
+        }
+
+    def create_error(self, status, headers=None):
+        headers = dict(headers or {})
+
+        if status == 429 and self.retry_after is not None:
+            headers["Retry-After"] = str(self.retry_after)
+
+        error = {"message": "Injected failure", "type": "server_error", "code": None}
+
+        return web.json_response({"error": error}, status=status, headers=headers)
+
+    async def handle_chat_completion(self, request):
+        data = await request.json()
+        model = data["model"]
+
+        self.requests[model] = self.requests.get(model, 0) + 1
+
+        await asyncio.sleep(sample_latency(self.latency))
+
+        if self.down or model in self.down_models:
+            return self.create_error(503)
+
+        if self.rate_limit is not None:
+            # the headers drop requests that left the window first
+            headers = self.get_rate_limit_headers()
+
+            if len(self.request_times) >= self.rate_limit:
+                return self.create_error(429, headers)
+
+            self.request_times.append(time.monotonic())
+
+        headers = self.get_rate_limit_headers()
+
+        if self.fail_first > 0:
+            self.fail_first -= 1
+
+            return self.create_error(random.choice(self.failure_statuses))
+
+        if random.random() < self.failure_rate:
+            return self.create_error(random.choice(self.failure_statuses))
+
+        content = "Ответ модели {}".format(model)
+
+        if not data.get("stream"):
+            return web.json_response({
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]
+            }, headers=headers)
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **headers})
+
+        await response.prepare(request)
+
+        for word in content.split(" "):
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+            }
+
+            await response.write("data: {}\n\n".format(json.dumps(chunk)).encode("utf-8"))
+
+        await response.write(b"data: [DONE]\n\n")
+
+        return response
+
+    async def handle_models(self, request):
+        if self.down:
+            return self.create_error(503)
+
+        models = [{"id": model, "object": "model", "created": 0, "owned_by": "benchmark"} for model in self.requests]
+
+        return web.json_response({"object": "list", "data": models})
+
+    async def start(self, port):
+        self.runner = web.AppRunner(self.web_application)
+
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+
+    return ordered[index]
+
+
+def print_report(name, total_time, latencies):
+    print("{}: {} requests in {:.2f}s".format(name, len(latencies), total_time))
+    print("  throughput: {:.1f} req/s".format(len(latencies) / total_time))
+    print("  p50 latency: {:.1f} ms".format(percentile(latencies, 50) * 1000))
+    print("  p95 latency: {:.1f} ms".format(percentile(latencies, 95) * 1000))
+    print("  p99 latency: {:.1f} ms".format(percentile(latencies, 99) * 1000))
+    print("  mean latency: {:.1f} ms".format(statistics.mean(latencies) * 1000))
+
+
+async def benchmark_updates(args):
+    processor = PerUserUpdateProcessor(args.workers)
+
+    latencies = []
+    processed = {}
+
+    async def handle(update, received_at):
+        await asyncio.sleep(random.uniform(args.min_latency, args.max_latency))
+
+        processed.setdefault(update.effective_user.id, []).append(update.update_id)
+        latencies.append(time.perf_counter() - received_at)
+
+    updates = []
+
+    for message_index in range(args.messages):
+        for user_id in range(1, args.users + 1):
+            updates.append(create_synthetic_update(len(updates) + 1, user_id, "Сообщение {}".format(message_index)))
+
+    start = time.perf_counter()
+
+    tasks = [
+        asyncio.create_task(processor.process_update(update, handle(update, time.perf_counter())))
+        for update in updates
+    ]
+
+    await asyncio.gather(*tasks)
+
+    total_time = time.perf_counter() - start
+
+    for user_updates in processed.values():
+        assert user_updates == sorted(user_updates), "updates of one user were processed out of order"
+
+    print_report("updates ({} users, {} workers)".format(args.users, args.workers), total_time, latencies)
+
+
+async def benchmark_quota(args):
+    users = MongoClient(args.mongo_uri).benchmark_database.users
+    quota_engine = QuotaEngine(users)
+
+    user_id = 1
+    model = "gpt-4o"
+
+    users.replace_one({"telegram_id": user_id}, {"telegram_id": user_id, model: args.quota}, upsert=True)
+
+    latencies = []
+
+    async def spend_credit():
+        start = time.perf_counter()
+
+        reservation = await quota_engine.reserve(user_id, model, {})
+
+        if reservation == None:
+            latencies.append(time.perf_counter() - start)
+
+            return "rejected"
+
+        # about one in five model calls fails and its credit is refunded
+        if random.random() < 0.2:
+            await quota_engine.refund(reservation, {})
+            result = "refunded"
+        else:
+            await quota_engine.commit(reservation)
+            result = "committed"
+
+        latencies.append(time.perf_counter() - start)
+
+        return result
+
+    start = time.perf_counter()
+
+    results = await asyncio.gather(*[spend_credit() for _ in range(args.requests)])
+
+    total_time = time.perf_counter() - start
+
+    user = users.find_one({"telegram_id": user_id})
+    committed = results.count("committed")
+
+    print("committed: {}, refunded: {}, rejected: {}".format(committed, results.count("refunded"), results.count("rejected")))
+
+    assert committed <= args.quota, "quota was over-spent"
+    assert user[model] == args.quota - committed, "credits were lost"
+    assert user["reserved"][model] == 0, "reservations were left open"
+
+    print_report("quota ({} parallel requests, quota {})".format(args.requests, args.quota), total_time, latencies)
+
+
+async def benchmark_streaming(args):
+    model_client = ModelClient(
+        FakeModelBackend(args.min_latency, args.max_latency, args.response_length, args.chunk_latency),
+        concurrency_limit=args.chats
+    )
+
+    messages = [{"role": "user", "content": "Привет"}]
+
+    async def answer_at_once(bot, chat_id):
+        start = time.perf_counter()
+
+        await bot.send_message(chat_id=chat_id, text="Обрабатываю запрос...")
+
+        completion = await model_client.chat_completion("gpt-4o-mini", messages)
+
+        await bot.send_message(chat_id=chat_id, text=completion.choices[0].message.content)
+
+        return time.perf_counter() - start
+
+    async def answer_streaming(bot, chat_id):
+        start = time.monotonic()
+
+        placeholder = await bot.send_message(chat_id=chat_id, text="Обрабатываю запрос...")
+
+        editor = StreamingMessageEditor(bot, chat_id, placeholder, edit_interval=args.edit_interval)
+
+        async for chunk in model_client.stream_chat_completion("gpt-4o-mini", messages):
+            await editor.append(chunk)
+
+        await editor.finish()
+
+        return editor.first_edit_time - start
+
+    for name, answer in [("complete response", answer_at_once), ("streaming", answer_streaming)]:
+        bot = FakeBot(args.bot_latency)
+
+        start = time.perf_counter()
+
+        latencies = await asyncio.gather(*[answer(bot, chat_id) for chat_id in range(args.chats)])
+
+        print_report("time to first text, {}".format(name), time.perf_counter() - start, latencies)
+        print("  bot api calls: {}".format(bot.calls))
+
+
+async def benchmark_webhook(args):
+    telegram_server = FakeTelegramServer(args.bot_latency)
+
+    await telegram_server.start(args.telegram_port)
+
+    os.environ.update({
+        "MODEL_BACKEND": "fake",
+        "FAKE_MODEL_MIN_LATENCY": str(args.min_latency),
+        "FAKE_MODEL_MAX_LATENCY": str(args.max_latency),
+        "MONGO_DB_URI": args.mongo_uri,
+        "TELEGRAM_BOT_API_KEY": "123456:benchmark",
+        "TELEGRAM_API_BASE_URL": "http://127.0.0.1:{}/bot".format(args.telegram_port)
+    })
+
+    # imported here so that the environment above is in place when the bot is configured
+    from telegram_bot import TelegramBot
+
+    telegram_bot = TelegramBot()
+
+    for logger_name in ["aiohttp.access", "httpx"]:
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    webhook_server = WebhookServer(
+        telegram_bot.application,
+        listen="127.0.0.1",
+        port=args.port,
+        path="/telegram",
+        secret_token="benchmark"
+    )
+
+    await webhook_server.start()
+
+    url = "http://127.0.0.1:{}/telegram".format(args.port)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    post_latencies = []
+
+    async def post_update(session, update):
+        async with semaphore:
+            start = time.perf_counter()
+
+            telegram_server.expect_answer(update.effective_chat.id)
+
+            async with session.post(url, json=update.to_dict(), headers={SECRET_TOKEN_HEADER: "benchmark"}) as response:
+                assert response.status == 200
+
+            post_latencies.append(time.perf_counter() - start)
+
+    updates = []
+
+    for message_index in range(args.messages):
+        for user_id in range(args.first_user_id, args.first_user_id + args.users):
+            updates.append(create_synthetic_update(len(updates) + 1, user_id, "Вопрос {}".format(message_index)))
+
+    start = time.perf_counter()
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[post_update(session, update) for update in updates])
+
+    post_time = time.perf_counter() - start
+
+    deadline = time.perf_counter() + args.timeout
+
+    while len(telegram_server.latencies) < len(updates) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    total_time = time.perf_counter() - start
+
+    print_report("webhook POST", post_time, post_latencies)
+    print_report("end-to-end handler latency", total_time, telegram_server.latencies)
+    print("  answered: {} of {}".format(len(telegram_server.latencies), len(updates)))
+    print("  bot api calls: {}".format(telegram_server.calls))
+
+    await webhook_server.stop()
+    await telegram_server.stop()
+
+
+async def benchmark_faults(args):
+    server = FakeOpenAIServer(args.latency)
+
+    await server.start(args.port)
+
+    backend = AsyncOpenAI(api_key="benchmark", base_url="http://127.0.0.1:{}/v1".format(args.port), max_retries=0)
+    messages = [{"role": "user", "content": "Привет"}]
+
+    def create_model_client(max_attempts):
+        retry_policy = RetryPolicy(max_attempts=max_attempts, base_delay=0.05, max_delay=0.5)
+
+        return ModelClient(backend, concurrency_limit=args.requests, retry_policy=retry_policy,
+                           failure_threshold=args.requests * 10, reset_timeout=args.reset_timeout)
+
+    async def try_completion(model_client, model):
+        try:
+            await model_client.chat_completion(model, messages)
+        except Exception:
+            return False
+
+        return True
+
+    # transient failures with and without retries
+    server.failure_rate = args.failure_rate
+
+    for max_attempts in [1, args.attempts]:
+        model_client = create_model_client(max_attempts)
+
+        start = time.perf_counter()
+
+        results = await asyncio.gather(*[try_completion(model_client, "gpt-4o-mini") for _ in range(args.requests)])
+
+        print("{:.0%} injected failures, {} attempts: {} of {} succeeded in {:.2f}s, retries: {}".format(
+            args.failure_rate, max_attempts, sum(results), args.requests, time.perf_counter() - start,
+            model_client.get_stats()["retries"]
+        ))
+
+    assert sum(results) >= args.requests * (1 - args.failure_rate ** args.attempts) * 0.9, "retries did not recover transient failures"
+
+    # Retry-After of a rate limited request is honoured
+    server.failure_rate = 0
+    server.failure_statuses = (429,)
+    server.retry_after = 0.5
+    server.fail_first = 1
+
+    start = time.perf_counter()
+
+    await create_model_client(args.attempts).chat_completion("gpt-4o-mini", messages)
+
+    elapsed = time.perf_counter() - start
+
+    print("429 with Retry-After 0.5s answered after {:.2f}s".format(elapsed))
+
+    assert elapsed >= 0.5, "Retry-After was not honoured"
+
+    # a model that is down opens its circuit and requests fall back
+    server.down_models.add("gpt-4o")
+    server.requests = {}
+
+    model_client = ModelClient(backend, retry_policy=RetryPolicy(max_attempts=args.attempts, base_delay=0.01),
+                               failure_threshold=args.failure_threshold, reset_timeout=args.reset_timeout)
+    fast_failures = 0
+    fallbacks = 0
+    loop_start = time.perf_counter()
+
+    for _ in range(args.requests):
+        start = time.perf_counter()
+
+        try:
+            await model_client.chat_completion("gpt-4o", messages)
+        except Exception as ex:
+            if isinstance(ex, CircuitOpenError):
+                fast_failures += 1
+
+            fallback_model = model_client.get_fallback_model("gpt-4o", ex)
+
+            if fallback_model and await try_completion(model_client, fallback_model):
+                fallbacks += 1
+
+    print("gpt-4o down: {} requests reached the server, {} failed fast, {} answered by the fallback".format(
+        server.requests.get("gpt-4o", 0), fast_failures, fallbacks
+    ))
+
+    # one trial request may pass every reset timeout
+    trials = int((time.perf_counter() - loop_start) / args.reset_timeout) + 1
+
+    assert server.requests.get("gpt-4o", 0) <= args.failure_threshold + trials, "the circuit did not open"
+    assert fallbacks == args.requests, "requests were not answered by the fallback model"
+
+    # after the reset timeout a trial request closes the circuit again
+    server.down_models.clear()
+
+    await asyncio.sleep(args.reset_timeout)
+
+    await model_client.chat_completion("gpt-4o", messages)
+
+    print("gpt-4o recovered, circuit states: {}".format(model_client.get_stats()["circuit_states"]))
+
+    assert model_client.get_circuit_breaker("gpt-4o").state == "closed", "the circuit did not close after recovery"
+
+    # streaming requests are retried until the stream is opened
+    server.fail_first = 1
+    server.retry_after = 0
+
+    chunks = [chunk async for chunk in model_client.stream_chat_completion("gpt-4o", messages)]
+
+    assert "".join(chunks).strip() == "Ответ модели gpt-4o", "the streamed answer is incomplete"
+
+    print("all fault scenarios passed")
+
+    await server.stop()
+
+
+async def benchmark_router(args):
+    servers = {
+        "fast": FakeOpenAIServer(LatencyDistribution(args.fast_latency)),
+        "slow": FakeOpenAIServer(LatencyDistribution(args.slow_latency)),
+        "local": FakeOpenAIServer(LatencyDistribution(args.fast_latency))
+    }
+
+    environ = {
+        "MODEL_ROUTER_BACKENDS": ",".join(servers),
+        "MODEL_ROUTER_LOCAL_MODELS": "gpt-4o-mini=llama3.1:8b",
+        "MODEL_ROUTER_LOCAL_COST": str(args.local_cost),
+        "MODEL_ROUTER_HEALTH_INTERVAL": str(args.health_interval),
+        "MODEL_ROUTER_HEALTH_TIMEOUT": "1",
+        "MODEL_CIRCUIT_FAILURE_THRESHOLD": str(args.failure_threshold),
+        "MODEL_CIRCUIT_RESET_TIMEOUT": str(args.reset_timeout),
+        "MODEL_CONCURRENCY_LIMIT": str(args.concurrency),
+        "MODEL_RETRY_BASE_DELAY": "0.05"
+    }
+
+    for index, (name, server) in enumerate(servers.items()):
+        await server.start(args.port + index)
+
+        environ["MODEL_ROUTER_{}_BASE_URL".format(name.upper())] = "http://127.0.0.1:{}/v1".format(args.port + index)
+        environ["MODEL_ROUTER_{}_API_KEY".format(name.upper())] = "benchmark"
+
+    model_client = create_model_client(environ)
+    router = model_client.router
+    messages = [{"role": "user", "content": "Привет"}]
+
+    router.start()
+
+    # every backend starts at the same assumed latency, so the ranking only means something
+    # once each has answered a few requests, whatever the number of requests measured after
+    for backend in router.backends:
+        model = next(iter(backend.model_names or ["gpt-4o"]))
+
+        for _ in range(args.warm_up_requests):
+            start = time.perf_counter()
+
+            await backend.client.chat.completions.create(model=backend.get_model_name(model), messages=messages)
+
+            backend.record_result(False, time.perf_counter() - start)
+
+    async def run(name, model):
+        for server in servers.values():
+            server.requests = {}
+
+        async def try_completion():
+            try:
+                await model_client.chat_completion(model, messages)
+            except Exception:
+                return False
+
+            return True
+
+        start = time.perf_counter()
+
+        results = await asyncio.gather(*[try_completion() for _ in range(args.requests)])
+
+        shares = {server_name: sum(server.requests.values()) for server_name, server in servers.items()}
+
+        print("{}: {} of {} {} requests succeeded in {:.2f}s, requests per backend: {}".format(
+            name, sum(results), args.requests, model, time.perf_counter() - start, shares
+        ))
+
+        return sum(results), shares
+
+    # the faster backend takes most requests, the slower one only the overflow
+    succeeded, shares = await run("latency", "gpt-4o")
+
+    assert succeeded == args.requests, "requests failed with every backend up"
+    assert shares["fast"] > shares["slow"], "the faster backend did not get more requests"
+    assert shares["local"] == 0, "a backend got a model it does not serve"
+
+    # a cheaper backend takes the models it serves, under its own model name
+    succeeded, shares = await run("cost", "gpt-4o-mini")
+
+    assert shares["local"] > shares["fast"], "the cheaper backend did not get more requests"
+    assert set(servers["local"].requests) == {"llama3.1:8b"}, "the model name was not mapped"
+
+    # a backend that runs out of rate limit is paused until its window resets
+    servers["local"].rate_limit = args.requests // 4
+    servers["local"].request_times.clear()
+
+    succeeded, shares = await run("rate limit", "gpt-4o-mini")
+
+    assert succeeded == args.requests, "requests failed when a backend ran out of rate limit"
+    assert shares["local"] <= args.requests // 4 + args.concurrency, "the rate limited backend was not paused"
+
+    servers["local"].rate_limit = None
+
+    # requests fail over from a backend that is down, which then fails its health check
+    servers["fast"].down = True
+
+    succeeded, shares = await run("fast down", "gpt-4o")
+
+    assert succeeded == args.requests, "requests were not failed over to another backend"
+    assert shares["fast"] <= args.failure_threshold + args.concurrency, "the circuit of the backend that is down did not open"
+
+    await asyncio.sleep(args.health_interval * 3)
+
+    print("  backend states: {}".format(router.get_stats()["backend_state"]))
+
+    assert router.get_stats()["backend_state"]["fast"] == "unhealthy", "the health check did not notice the backend is down"
+
+    # once it passes the health check and its circuit lets a trial through it gets requests again
+    servers["fast"].down = False
+
+    await asyncio.sleep(max(args.health_interval * 3, args.reset_timeout))
+
+    # one at a time the recovered backend ranks first again, and its rolling latency and
+    # error rate settle before the measured requests
+    servers["fast"].requests = {}
+
+    for _ in range(args.warm_up_requests * 10):
+        if sum(servers["fast"].requests.values()) >= args.warm_up_requests:
+            break
+
+        await model_client.chat_completion("gpt-4o", messages)
+
+    assert sum(servers["fast"].requests.values()) >= args.warm_up_requests, "the recovered backend did not get requests again"
+
+    succeeded, shares = await run("fast recovered", "gpt-4o")
+
+    print("  backend states: {}".format(router.get_stats()["backend_state"]))
+
+    assert succeeded == args.requests and shares["fast"] > shares["slow"], "the recovered backend did not get most requests again"
+
+    print("  backend latency: {}".format(router.get_stats()["backend_latency_seconds"]))
+    print("all router scenarios passed")
+
+    await router.stop()
+
+    for server in servers.values():
+        await server.stop()
+
+
+def create_user_document(user_id):
+    premium = user_id % 10 == 0
+
+    return {
+        "telegram_id": user_id,
+        "current_model": "gpt-4o" if premium else "gpt-4o-mini",
+        "gpt-4o-mini": "Безлимит" if premium else user_id % 6,
+        "gpt-4o": 25 if premium else 0,
+        "dall-e-3": 25 if premium else 0,
+        "whisper": "Безлимит" if premium else 0,
+        "subscription": "Lite" if premium else "Free",
+        "last_free_request_date": (date(2026, 1, 1) + timedelta(days=user_id % 30)).isoformat(),
+        "subscription_expiry_date": "2026-02-01" if premium else "Безлимит"
+    }
+
+
+def measure_memory(create_users):
+    tracemalloc.start()
+
+    start = time.perf_counter()
+    users = create_users()
+    elapsed = time.perf_counter() - start
+
+    memory = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.stop()
+
+    return users, memory, elapsed
+
+
+async def benchmark_user_state(args):
+    results = {}
+
+    # the documents are created like pymongo decodes them, each with its own strings, and dropped after loading
+    for name, create_users in [
+        ("dict", lambda: {user_id: {key: value for key, value in create_user_document(user_id).items() if key != "telegram_id"} for user_id in range(args.users)}),
+        ("UserState", lambda: {user_id: UserState.from_bson(create_user_document(user_id)) for user_id in range(args.users)})
+    ]:
+        users, memory, elapsed = measure_memory(create_users)
+
+        results[name] = users
+
+        print("{}: {:.1f} MB for {} users, {:.0f} bytes per user, loaded in {:.2f}s".format(
+            name, memory / 1024 ** 2, args.users, memory / args.users, elapsed
+        ))
+
+    states = list(results["UserState"].values())
+
+    start = time.perf_counter()
+
+    for state in states:
+        state.to_bson()
+
+    print("to_bson: {:.2f} us per user".format((time.perf_counter() - start) / len(states) * 1e6))
+
+    for state in states[:1000]:
+        state["current_model"] = "gpt-4o"
+
+    start = time.perf_counter()
+
+    changed = sum(len(state.to_bson(dirty_only=True)) for state in states)
+
+    print("dirty fields after 1000 model changes: {} (in {:.2f}s)".format(changed, time.perf_counter() - start))
+
+    assert changed == 1000, "clean users would be written"
+    assert results["UserState"][0]["gpt-4o-mini"] == UNLIMITED, "the unlimited quota was not converted"
+
+
+def measure_calls(name, calls, function):
+    latencies = []
+
+    start = time.perf_counter()
+
+    for _ in range(calls):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_start)
+
+    print_report(name, time.perf_counter() - start, latencies)
+
+
+async def benchmark_mongo(args):
+    db = MongoClient(args.mongo_uri, maxPoolSize=args.pool_size).benchmark_database
+    users = db.users
+
+    if args.seed or users.estimated_document_count() < args.users:
+        users.drop()
+        db.conversations.drop()
+
+        start = time.perf_counter()
+
+        for first_user_id in range(0, args.users, args.batch_size):
+            last_user_id = min(args.users, first_user_id + args.batch_size)
+
+            users.insert_many(
+                [{"telegram_id": user_id, **UserState.from_bson(create_user_document(user_id)).to_bson()} for user_id in range(first_user_id, last_user_id)],
+                ordered=False
+            )
+
+        print("seeded {} users in {:.1f}s".format(args.users, time.perf_counter() - start))
+
+    if args.no_indexes:
+        users.drop_indexes()
+    else:
+        start = time.perf_counter()
+
+        create_user_indexes(db)
+
+        print("indexes ready in {:.1f}s".format(time.perf_counter() - start))
+
+    def random_user_id():
+        return random.randrange(args.users)
+
+    measure_calls("find_one, full document", args.calls, lambda: users.find_one({"telegram_id": random_user_id()}))
+    measure_calls("find_one, projection", args.calls, lambda: users.find_one({"telegram_id": random_user_id()}, USER_PROJECTION))
+    measure_calls("upsert", args.calls, lambda: users.update_one(
+        {"telegram_id": random_user_id()},
+        {"$set": {"current_model": "gpt-4o"}},
+        upsert=True
+    ))
+    measure_calls("quota decrement", args.calls, lambda: users.find_one_and_update(
+        {"telegram_id": random_user_id(), "gpt-4o-mini": {"$gt": 0}},
+        {"$inc": {"gpt-4o-mini": -1}},
+        projection={"gpt-4o-mini": 1}
+    ))
+
+    print("explain of a lookup: {}".format(
+        users.find({"telegram_id": 1}).explain()["queryPlanner"]["winningPlan"]
+    ))
+
+
+async def exercise_shared_state(mongo_uri, worker_index, iterations, user_id):
+    mongo_client = MongoClient(mongo_uri)
+    persistence = MongoDBPersistence(mongo_client, shared=True, database="benchmark_database")
+    quota_engine = QuotaEngine(persistence.users_collection)
+
+    user_data = UserState()
+    committed = 0
+
+    for iteration in range(iterations):
+        await persistence.refresh_user_data(user_id, user_data)
+
+        user_data["worker_{}".format(worker_index)] = iteration + 1
+        user_data["messages"] = user_data["messages"] + [{"role": "user", "content": "worker {} turn {}".format(worker_index, iteration)}]
+
+        reservation = await quota_engine.reserve(user_id, "gpt-4o", user_data)
+
+        if reservation != None:
+            await quota_engine.commit(reservation)
+
+            committed += 1
+
+        await persistence.update_user_data(user_id, deepcopy(user_data))
+
+    return committed
+
+
+def run_shared_state_worker(mongo_uri, worker_index, iterations, user_id):
+    return asyncio.run(exercise_shared_state(mongo_uri, worker_index, iterations, user_id))
+
+
+async def benchmark_multiworker(args):
+    db = MongoClient(args.mongo_uri).benchmark_database
+    users = db.users
+
+    user_id = args.user_id
+
+    # shared mode relies on the unique indexes to not create a user twice
+    create_user_indexes(db)
+
+    users.delete_one({"telegram_id": user_id})
+    db.conversations.delete_one({"telegram_id": user_id})
+
+    user = {"telegram_id": user_id, "subscription": "Free", "current_model": "gpt-4o", "gpt-4o": args.quota}
+
+    users.insert_one(user)
+
+    loop = asyncio.get_running_loop()
+
+    start = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        committed = await asyncio.gather(*[
+            loop.run_in_executor(executor, run_shared_state_worker, args.mongo_uri, worker_index, args.iterations, user_id)
+            for worker_index in range(args.workers)
+        ])
+
+    total_time = time.perf_counter() - start
+
+    user = users.find_one({"telegram_id": user_id})
+
+    print("{} workers x {} updates of one user in {:.2f}s".format(args.workers, args.iterations, total_time))
+    print("  committed credits: {}, remaining: {}, version: {}".format(sum(committed), user["gpt-4o"], user.get("version")))
+
+    assert sum(committed) <= args.quota, "quota was over-spent"
+    assert user["gpt-4o"] == args.quota - sum(committed), "credits were lost"
+
+    for worker_index in range(args.workers):
+        assert user["worker_{}".format(worker_index)] == args.iterations, "a worker's update was overwritten"
+
+    conversation = db.conversations.find_one({"telegram_id": user_id})
+    contents = [message["content"] for message in conversation["messages"]] if conversation else []
+
+    print("  stored messages: {}, version: {}".format(len(contents), conversation.get("version") if conversation else None))
+
+    for worker_index in range(args.workers):
+        for iteration in range(args.iterations):
+            assert "worker {} turn {}".format(worker_index, iteration) in contents, "a worker's message was lost"
+
+    users.delete_one({"telegram_id": user_id})
+    db.conversations.delete_one({"telegram_id": user_id})
+
+
+def create_synthetic_log(args):
+    """Creates the events of users that start the bot, some buy a subscription or switch the model, and chat."""
+    events = []
+
+    for user_id in range(args.first_user_id, args.first_user_id + args.users):
+        session = [{"type": "message", "text": "/start"}]
+
+        if random.random() < args.premium_share:
+            payload = "Bot-Subscription-{}".format(random.choice(["Lite", "Smart", "Pro"]))
+
+            session += [
+                {"type": "message", "text": "/premium"},
+                {"type": "callback", "data": payload.split("-")[2]},
+                {"type": "pre_checkout", "payload": payload},
+                {"type": "payment", "payload": payload}
+            ]
+
+        if random.random() < args.model_switch_share:
+            session += [{"type": "message", "text": "/model"}, {"type": "callback", "data": "gpt-4o"}]
+
+        session += [{"type": "message", "text": "Вопрос {}".format(index)} for index in range(args.messages)]
+
+        at = random.uniform(0, args.duration)
+
+        for event in session:
+            events.append(dict(event, at=round(at, 3), user_id=user_id))
+
+            at += random.expovariate(1 / args.think_time)
+
+    return sorted(events, key=lambda event: event["at"])
+
+
+def create_replay_update(update_id, event):
+    """Creates the Bot API update of one event of a replay log."""
+    user = {"id": event["user_id"], "is_bot": False, "first_name": "user{}".format(event["user_id"])}
+    chat = {"id": event["user_id"], "type": "private"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user}
+    amount = event.get("amount", 99900)
+
+    if event["type"] == "message":
+        message["text"] = event["text"]
+
+        if event["text"].startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(event["text"].split()[0])}]
+
+        return {"update_id": update_id, "message": message}
+
+    if event["type"] == "callback":
+        callback_query = {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(event["user_id"]),
+            "data": event["data"],
+            "message": dict(message, text="Выберите:")
+        }
+
+        return {"update_id": update_id, "callback_query": callback_query}
+
+    if event["type"] == "pre_checkout":
+        pre_checkout_query = {
+            "id": str(update_id),
+            "from": user,
+            "currency": "RUB",
+            "total_amount": amount,
+            "invoice_payload": event["payload"]
+        }
+
+        return {"update_id": update_id, "pre_checkout_query": pre_checkout_query}
+
+    if event["type"] == "payment":
+        message["successful_payment"] = {
+            "currency": "RUB",
+            "total_amount": amount,
+            "invoice_payload": event["payload"],
+            "telegram_payment_charge_id": event.get("charge_id", "replay-{}".format(update_id)),
+            "provider_payment_charge_id": event.get("charge_id", "replay-{}".format(update_id))
+        }
+
+        return {"update_id": update_id, "message": message}
+
+    raise ValueError("Unknown event type: {}".format(event["type"]))
+
+
+async def monitor_loop_lag(lags, interval=0.01):
+    while True:
+        start = time.perf_counter()
+
+        await asyncio.sleep(interval)
+
+        lags.append(max(0, time.perf_counter() - start - interval))
+
+
+def get_peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def benchmark_replay(args):
+    if args.log:
+        with open(args.log, encoding="utf-8") as log_file:
+            events = sorted((json.loads(line) for line in log_file if line.strip()), key=lambda event: event.get("at", 0))
+    else:
+        events = create_synthetic_log(args)
+
+    if args.write_log:
+        with open(args.write_log, "w", encoding="utf-8") as log_file:
+            for event in events:
+                log_file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    telegram_server = FakeTelegramServer(LatencyDistribution(args.bot_latency))
+    openai_server = FakeOpenAIServer(LatencyDistribution(args.model_latency))
+
+    await telegram_server.start(args.telegram_port)
+    await openai_server.start(args.openai_port)
+
+    os.environ.pop("MODEL_BACKEND", None)
+    os.environ.update({
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": "http://127.0.0.1:{}/v1".format(args.openai_port),
+        "MONGO_DB_URI": args.mongo_uri,
+        "TELEGRAM_BOT_API_KEY": "123456:benchmark",
+        "TELEGRAM_API_BASE_URL": "http://127.0.0.1:{}/bot".format(args.telegram_port)
+    })
+
+    mongo_client = None
+
+    if args.mongo_uri == "memory":
+        # mongomock is only needed for this mode, so it is not in requirements.txt
+        import mongomock
+
+        mongo_client = mongomock.MongoClient()
+
+    for logger_name in ["aiohttp.access", "httpx", "apscheduler"]:
+        logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    rss_before = get_peak_rss()
+
+    from telegram_bot import TelegramBot
+
+    telegram_bot = TelegramBot(mongo_client=mongo_client)
+    application = telegram_bot.application
+
+    enqueued = {}
+    latencies = collections.defaultdict(list)
+
+    # the last group runs after the handlers of the update are done
+    async def record_processed(update, context):
+        enqueued_at, event_type = enqueued.pop(update.update_id)
+
+        latencies[event_type].append(time.perf_counter() - enqueued_at)
+
+    application.add_handler(TypeHandler(Update, record_processed), group=99)
+
+    await application.initialize()
+
+    if application.post_init:
+        await application.post_init(application)
+
+    await application.start()
+
+    traced_before = tracemalloc.get_traced_memory()[0] if args.trace_memory else 0
+    lags = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+
+    start = time.perf_counter()
+
+    for update_id, event in enumerate(events, 1):
+        delay = event.get("at", 0) / args.speed - (time.perf_counter() - start)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        update = Update.de_json(create_replay_update(update_id, event), application.bot)
+
+        enqueued[update_id] = (time.perf_counter(), event["type"])
+
+        await application.update_queue.put(update)
+
+    deadline = time.perf_counter() + args.timeout
+
+    while enqueued and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+    total_time = time.perf_counter() - start
+
+    lag_task.cancel()
+
+    users = len({event["user_id"] for event in events})
+    all_latencies = [latency for event_latencies in latencies.values() for latency in event_latencies]
+
+    print_report("replay", total_time, all_latencies)
+    print("  processed: {} of {} updates from {} users".format(len(all_latencies), len(events), users))
+
+    for event_type, event_latencies in sorted(latencies.items()):
+        print("  {}: {} updates, p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms".format(
+            event_type,
+            len(event_latencies),
+            percentile(event_latencies, 50) * 1000,
+            percentile(event_latencies, 95) * 1000,
+            percentile(event_latencies, 99) * 1000
+        ))
+
+    if args.trace_memory:
+        print("  python memory growth: {:.0f} bytes per user".format((tracemalloc.get_traced_memory()[0] - traced_before) / users))
+
+    print("  peak rss growth: {:.0f} bytes per user".format((get_peak_rss() - rss_before) / users))
+
+    blocked = [lag for lag in lags if lag >= args.block_threshold]
+
+    print("  event loop lag: p99 {:.1f} ms, max {:.1f} ms, blocked {:.2f}s in {} stalls over {:.0f} ms".format(
+        percentile(lags, 99) * 1000,
+        max(lags) * 1000,
+        sum(blocked),
+        len(blocked),
+        args.block_threshold * 1000
+    ))
+    print("  bot api calls: {}".format(telegram_server.calls))
+    print("  model requests: {}".format(openai_server.requests))
+
+    await application.stop()
+
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+    await application.shutdown()
+
+    await openai_server.stop()
+    await telegram_server.stop()
+
+    if args.trace_memory:
+        tracemalloc.stop()
+
+# runs in a fresh interpreter, so it must not import anything the bot imports before it is measured
+STARTUP_CHILD = """
+import time
+script_start = time.time()
+start = time.perf_counter()
+
+from telegram_bot import TelegramBot
+
+import_time = time.perf_counter() - start
+
+import asyncio
+import json
+import sys
+from datetime import date
+from telegram import Update
+from telegram.ext import TypeHandler
+from user_state import UserState
+
+
+async def main(mongo_uri, users):
+    mongo_client = None
+    seed_start = time.time()
+
+    if mongo_uri == "memory":
+        import mongomock
+
+        mongo_client = mongomock.MongoClient()
+
+        # seeded users are what an eager boot has to load
+        document = UserState.create_new(date.today()).to_bson()
+
+        if users > 0:
+            mongo_client.user_database.users.insert_many([dict(document, telegram_id=user_id) for user_id in range(1, users + 1)])
+
+    # seeding is not part of the startup
+    seed_time = time.time() - seed_start
+
+    start = time.perf_counter()
+    telegram_bot = TelegramBot(mongo_client=mongo_client)
+    application = telegram_bot.application
+    construct_time = time.perf_counter() - start
+    handled = asyncio.Event()
+
+    async def record_handled(update, context):
+        handled.set()
+
+    application.add_handler(TypeHandler(Update, record_handled), group=99)
+
+    start = time.perf_counter()
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    start_time = time.perf_counter() - start
+    user = {"id": 1, "is_bot": False, "first_name": "user1"}
+    message = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": 1, "type": "private"},
+        "from": user,
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+    }
+
+    await application.update_queue.put(Update.de_json({"update_id": 1, "message": message}, application.bot))
+    await handled.wait()
+
+    first_update_time = time.time() - script_start - seed_time
+
+    await telegram_bot.ready.wait()
+
+    ready_time = time.time() - script_start - seed_time
+
+    print("startup result: " + json.dumps({
+        "script_start": script_start,
+        "import": import_time,
+        "construct": construct_time,
+        "start": start_time,
+        "first_update": first_update_time,
+        "ready": ready_time
+    }))
+
+    await application.stop()
+    await application.post_shutdown(application)
+    await application.shutdown()
+
+
+asyncio.run(main(sys.argv[1], int(sys.argv[2])))
+"""
+
+
+async def benchmark_startup(args):
+    telegram_server = FakeTelegramServer(LatencyDistribution(args.bot_latency))
+
+    await telegram_server.start(args.telegram_port)
+
+    environ = dict(
+        os.environ,
+        MONGO_DB_URI=args.mongo_uri,
+        OPENAI_API_KEY="benchmark",
+        TELEGRAM_BOT_API_KEY="123456:benchmark",
+        TELEGRAM_API_BASE_URL="http://127.0.0.1:{}/bot".format(args.telegram_port),
+        PERSISTENCE_LAZY="0" if args.eager else "1"
+    )
+    environ.pop("MODEL_BACKEND", None)
+    environ.pop("METRICS_PORT", None)
+
+    runs = collections.defaultdict(list)
+
+    for _ in range(args.runs):
+        spawned_at = time.time()
+
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", STARTUP_CHILD, args.mongo_uri, str(args.users),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=environ,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=args.timeout)
+
+        if process.returncode != 0:
+            raise RuntimeError("The startup run exited with {}:\n{}".format(process.returncode, stderr.decode("utf-8")[-2000:]))
+
+        # the bot prints its own progress as well
+        result = json.loads(next(line for line in stdout.decode("utf-8").splitlines() if line.startswith("startup result: "))[len("startup result: "):])
+
+        runs["interpreter"].append(result.pop("script_start") - spawned_at)
+
+        for phase, seconds in result.items():
+            runs[phase].append(seconds)
+
+    await telegram_server.stop()
+
+    print("startup: {} runs, {} users, {} loading".format(args.runs, args.users, "eager" if args.eager else "lazy"))
+
+    descriptions = {
+        "interpreter": "interpreter start",
+        "import": "import telegram_bot",
+        "construct": "TelegramBot()",
+        "start": "initialize and start",
+        "first_update": "first handled update, since the script started",
+        "ready": "ready, since the script started"
+    }
+
+    for phase, description in descriptions.items():
+        print("  {}: mean {:.1f} ms, min {:.1f} ms".format(description, statistics.mean(runs[phase]) * 1000, min(runs[phase]) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local benchmarks for the telegram bot")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    updates_parser = subparsers.add_parser("updates", help="replay synthetic users through the update processor")
+    updates_parser.add_argument("--users", type=int, default=200)
+    updates_parser.add_argument("--messages", type=int, default=5)
+    updates_parser.add_argument("--workers", type=int, default=64)
+    updates_parser.add_argument("--min-latency", type=float, default=0.05)
+    updates_parser.add_argument("--max-latency", type=float, default=0.2)
+    updates_parser.set_defaults(function=benchmark_updates)
+
+    quota_parser = subparsers.add_parser("quota", help="spend one user's quota from parallel requests against a local mongod")
+    quota_parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    quota_parser.add_argument("--requests", type=int, default=500)
+    quota_parser.add_argument("--quota", type=int, default=100)
+    quota_parser.set_defaults(function=benchmark_quota)
+
+    streaming_parser = subparsers.add_parser("streaming", help="compare time to first text with and without streaming")
+    streaming_parser.add_argument("--chats", type=int, default=100)
+    streaming_parser.add_argument("--min-latency", type=float, default=0.3)
+    streaming_parser.add_argument("--max-latency", type=float, default=0.8)
+    streaming_parser.add_argument("--response-length", type=int, default=6000)
+    streaming_parser.add_argument("--chunk-latency", type=float, default=0.02)
+    streaming_parser.add_argument("--bot-latency", type=float, default=0.05)
+    streaming_parser.add_argument("--edit-interval", type=float, default=1.0)
+    streaming_parser.set_defaults(function=benchmark_streaming)
+
+    webhook_parser = subparsers.add_parser("webhook", help="post synthetic updates to the webhook server, with fake Bot API and model backend")
+    webhook_parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    webhook_parser.add_argument("--users", type=int, default=200)
+    webhook_parser.add_argument("--messages", type=int, default=3)
+    webhook_parser.add_argument("--first-user-id", type=int, default=1000000)
+    webhook_parser.add_argument("--concurrency", type=int, default=50)
+    webhook_parser.add_argument("--port", type=int, default=8443)
+    webhook_parser.add_argument("--telegram-port", type=int, default=8081)
+    webhook_parser.add_argument("--min-latency", type=float, default=0.3)
+    webhook_parser.add_argument("--max-latency", type=float, default=1.0)
+    webhook_parser.add_argument("--bot-latency", type=float, default=0.05)
+    webhook_parser.add_argument("--timeout", type=float, default=60)
+    webhook_parser.set_defaults(function=benchmark_webhook)
+
+    multiworker_parser = subparsers.add_parser("multiworker", help="update one user from several processes sharing state through a local mongod")
+    multiworker_parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    multiworker_parser.add_argument("--workers", type=int, default=4)
+    multiworker_parser.add_argument("--iterations", type=int, default=100)
+    multiworker_parser.add_argument("--quota", type=int, default=250)
+    multiworker_parser.add_argument("--user-id", type=int, default=999000001)
+    multiworker_parser.set_defaults(function=benchmark_multiworker)
+
+    faults_parser = subparsers.add_parser("faults", help="check retries, circuit breaker and fallback against a fault-injecting fake OpenAI server")
+    faults_parser.add_argument("--port", type=int, default=8082)
+    faults_parser.add_argument("--requests", type=int, default=200)
+    faults_parser.add_argument("--failure-rate", type=float, default=0.3)
+    faults_parser.add_argument("--attempts", type=int, default=3)
+    faults_parser.add_argument("--failure-threshold", type=int, default=5)
+    faults_parser.add_argument("--reset-timeout", type=float, default=1.0)
+    faults_parser.add_argument("--latency", type=float, default=0.02)
+    faults_parser.set_defaults(function=benchmark_faults)
+
+    router_parser = subparsers.add_parser("router", help="check routing by latency, cost, rate limits and health over local stub OpenAI servers")
+    router_parser.add_argument("--requests", type=int, default=200)
+    router_parser.add_argument("--concurrency", type=int, default=10)
+    router_parser.add_argument("--warm-up-requests", type=int, default=10, help="requests to each backend before the measured ones")
+    router_parser.add_argument("--fast-latency", default="0.02")
+    router_parser.add_argument("--slow-latency", default="0.2")
+    router_parser.add_argument("--local-cost", type=float, default=0.2)
+    router_parser.add_argument("--failure-threshold", type=int, default=3)
+    router_parser.add_argument("--reset-timeout", type=float, default=1)
+    router_parser.add_argument("--health-interval", type=float, default=0.2)
+    router_parser.add_argument("--port", type=int, default=8083, help="first of three ports for the stub servers")
+    router_parser.set_defaults(function=benchmark_router)
+
+    user_state_parser = subparsers.add_parser("userstate", help="compare memory of user data as dicts and as UserState")
+    user_state_parser.add_argument("--users", type=int, default=1000000)
+    user_state_parser.set_defaults(function=benchmark_user_state)
+
+    mongo_parser = subparsers.add_parser("mongo", help="seed a local mongod with users and measure lookup and upsert latency")
+    mongo_parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    mongo_parser.add_argument("--users", type=int, default=1000000)
+    mongo_parser.add_argument("--batch-size", type=int, default=10000)
+    mongo_parser.add_argument("--calls", type=int, default=5000)
+    mongo_parser.add_argument("--pool-size", type=int, default=100)
+    mongo_parser.add_argument("--seed", action="store_true", help="seed again even if the users exist")
+    mongo_parser.add_argument("--no-indexes", action="store_true", help="drop the indexes to compare with collection scans")
+    mongo_parser.set_defaults(function=benchmark_mongo)
+
+    replay_parser = subparsers.add_parser("replay", help="replay a JSONL log of user events through the bot's handlers with fake Bot API and OpenAI servers")
+    replay_parser.add_argument("--log", help="JSONL file of events, a synthetic log is generated when omitted")
+    replay_parser.add_argument("--write-log", help="write the replayed events to this JSONL file")
+    replay_parser.add_argument("--mongo-uri", default="memory", help="a local mongod or memory for an in-memory mongomock database")
+    replay_parser.add_argument("--users", type=int, default=200)
+    replay_parser.add_argument("--messages", type=int, default=5)
+    replay_parser.add_argument("--first-user-id", type=int, default=2000000)
+    replay_parser.add_argument("--duration", type=float, default=10, help="seconds over which the synthetic users start")
+    replay_parser.add_argument("--think-time", type=float, default=2, help="mean seconds between two events of a user")
+    replay_parser.add_argument("--premium-share", type=float, default=0.1)
+    replay_parser.add_argument("--model-switch-share", type=float, default=0.2)
+    replay_parser.add_argument("--speed", type=float, default=1, help="replay this many times faster than logged")
+    replay_parser.add_argument("--bot-latency", default="lognormal:0.05,0.5")
+    replay_parser.add_argument("--model-latency", default="lognormal:0.8,0.6")
+    replay_parser.add_argument("--telegram-port", type=int, default=8081)
+    replay_parser.add_argument("--openai-port", type=int, default=8082)
+    replay_parser.add_argument("--block-threshold", type=float, default=0.05, help="event loop lag in seconds counted as blocking")
+    replay_parser.add_argument("--trace-memory", action="store_true", help="measure python memory with tracemalloc, which slows the replay")
+    replay_parser.add_argument("--timeout", type=float, default=120)
+    replay_parser.set_defaults(function=benchmark_replay)
+
+    startup_parser = subparsers.add_parser("startup", help="measure import time and time to the first handled update of fresh bot processes")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--mongo-uri", default="memory", help="a local mongod or memory for an in-memory mongomock database")
+    startup_parser.add_argument("--users", type=int, default=0, help="users seeded into the in-memory database")
+    startup_parser.add_argument("--eager", action="store_true", help="load every user at startup instead of on first access")
+    startup_parser.add_argument("--bot-latency", default="0.05")
+    startup_parser.add_argument("--telegram-port", type=int, default=8081)
+    startup_parser.add_argument("--timeout", type=float, default=60)
+    startup_parser.set_defaults(function=benchmark_startup)
+
+    args = parser.parse_args()
+
+    asyncio.run(args.function(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import time
+from telegram.request import HTTPXRequest
+import metrics
+
+BOT_API_DURATION = metrics.histogram("bot_api_duration_seconds", "Duration of Bot API calls", ["method"])
+BOT_API_ERRORS = metrics.counter("bot_api_errors_total", "Failed Bot API calls by error type", ["method", "error"])
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the duration and errors of every Bot API call by method."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+
+        try:
+            result = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as ex:
+            BOT_API_ERRORS.inc(method=api_method, error=type(ex).__name__)
+
+            raise
+
+        BOT_API_DURATION.observe(time.perf_counter() - start, method=api_method)
+
+        return result
+
+
+def create_bot_request(environ):
+    """Creates the request of the Bot API client with the pool size and timeouts set in the environment."""
+    return InstrumentedRequest(
+        connection_pool_size=int(environ.get("BOT_CONNECTION_POOL_SIZE", 256)),
+        connect_timeout=float(environ.get("BOT_CONNECT_TIMEOUT", 5)),
+        read_timeout=float(environ.get("BOT_READ_TIMEOUT", 10)),
+        write_timeout=float(environ.get("BOT_WRITE_TIMEOUT", 10)),
+        # bursts wait for a free connection instead of failing after the default second
+        pool_timeout=float(environ.get("BOT_POOL_TIMEOUT", 5))
+    )
@@ -0,0 +1,153 @@
+import sys
+from functools import lru_cache
+from model_enum import Enum
+
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# upper bound of a high detail image part and cost of a low detail one, see the OpenAI vision pricing
+IMAGE_TOKENS = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+SUMMARY_PREFIX = "Краткое содержание предыдущего диалога: "
+
+DEFAULT_TOKEN_BUDGETS = {
+    Enum.GPT4O_MINI.value: 16000,
+    Enum.GPT4O.value: 8000
+}
+
+encoding = None
+
+
+def get_encoding():
+    global encoding
+
+    if encoding is None:
+        try:
+            import tiktoken
+
+            encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # no tokenizer available offline, fall back to an estimate
+            encoding = False
+
+    return encoding
+
+
+@lru_cache(maxsize=65536)
+def count_text_tokens(text):
+    current_encoding = get_encoding()
+
+    if current_encoding:
+        return len(current_encoding.encode(text))
+
+    return len(text) // 3 + 1
+
+
+def count_message_tokens(message):
+    content = message["content"]
+
+    if isinstance(content, str):
+        return MESSAGE_TOKEN_OVERHEAD + count_text_tokens(content)
+
+    tokens = MESSAGE_TOKEN_OVERHEAD
+
+    for part in content:
+        if part["type"] == "text":
+            tokens += count_text_tokens(part["text"])
+        elif part["image_url"].get("detail") == "low":
+            tokens += LOW_DETAIL_IMAGE_TOKENS
+        else:
+            tokens += IMAGE_TOKENS
+
+    return tokens
+
+
+def parse_token_budgets(value):
+    """Parses "gpt-4o-mini=16000,gpt-4o=8000" into a dict of token budgets."""
+    token_budgets = dict(DEFAULT_TOKEN_BUDGETS)
+
+    if not value:
+        return token_budgets
+
+    for item in value.split(","):
+        model, budget = item.split("=")
+        token_budgets[model.strip()] = int(budget)
+
+    return token_budgets
+
+
+class ConversationWindow():
+    """Keeps the chat history of a user within the token budget of the current model.
+
+    When the history is over budget the oldest turns are dropped until it fits into
+    trim_ratio of the budget, so trimming (and summarizing) does not happen on every turn.
+    """
+
+    def __init__(self, token_budgets, model_client=None, summarize=False, summary_model=Enum.GPT4O_MINI.value, trim_ratio=0.75):
+        self.token_budgets = token_budgets
+        self.model_client = model_client
+        self.summarize = summarize
+        self.summary_model = summary_model
+        self.trim_ratio = trim_ratio
+
+    def count_tokens(self, messages):
+        return sum(count_message_tokens(message) for message in messages)
+
+    async def fit(self, model, messages):
+        budget = self.token_budgets.get(model)
+
+        if budget is None or self.count_tokens(messages) <= budget:
+            return messages
+
+        target = budget * self.trim_ratio
+        dropped = []
+
+        # the latest message is the request itself and is always kept
+        while len(messages) > 1 and self.count_tokens(messages) > target:
+            dropped.append(messages.pop(0))
+
+        if self.summarize and self.model_client:
+            summary = await self.create_summary(dropped)
+
+            if summary:
+                messages.insert(0, {"role": "system", "content": SUMMARY_PREFIX + summary})
+
+        return messages
+
+    async def create_summary(self, dropped):
+        lines = []
+
+        for message in dropped:
+            content = message["content"]
+
+            if not isinstance(content, str):
+                content = " ".join(part["text"] for part in content if part["type"] == "text")
+
+            if message["role"] == "system" and content.startswith(SUMMARY_PREFIX):
+                content = content[len(SUMMARY_PREFIX):]
+
+            lines.append("{}: {}".format(message["role"], content))
+
+        try:
+            completion = await self.model_client.chat_completion(
+                self.summary_model,
+                [
+                    {"role": "system", "content": "Кратко перескажи диалог, сохранив важные факты и договоренности."},
+                    {"role": "user", "content": "\n".join(lines)}
+                ]
+            )
+
+            return completion.choices[0].message.content
+        except Exception as ex:
+            print(ex)
+
+            return None
+
+    def get_stats(self, messages):
+        return {
+            "messages": len(messages),
+            "tokens": self.count_tokens(messages),
+            "memory": sys.getsizeof(messages) + sum(
+                sys.getsizeof(message) + sys.getsizeof(message["content"]) for message in messages
+            )
+        }
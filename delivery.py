@@ -0,0 +1,149 @@
+import io
+from telegram import InputFile
+from telegram.constants import ParseMode, MessageLimit
+from telegram.error import BadRequest
+
+CODE_FENCE = "```"
+
+
+def split_into_blocks(text):
+    """Splits text into paragraphs and whole code blocks."""
+    blocks = []
+    lines = []
+    in_code = False
+
+    for line in text.split("\n"):
+        if line.strip().startswith(CODE_FENCE):
+            if not in_code and lines:
+                blocks.append("\n".join(lines))
+                lines = []
+
+            lines.append(line)
+            in_code = not in_code
+
+            if not in_code:
+                blocks.append("\n".join(lines))
+                lines = []
+        elif not in_code and line.strip() == "":
+            if lines:
+                blocks.append("\n".join(lines))
+                lines = []
+        else:
+            lines.append(line)
+
+    if lines:
+        blocks.append("\n".join(lines))
+
+    return blocks
+
+
+def split_long_block(block, max_length):
+    lines = block.split("\n")
+    fence = None
+
+    if lines[0].strip().startswith(CODE_FENCE):
+        fence = lines[0]
+        lines = lines[1:-1] if lines[-1].strip() == CODE_FENCE else lines[1:]
+        # room for the fence lines that wrap every piece
+        max_length -= len(fence) + len(CODE_FENCE) + 2
+
+    pieces = []
+    current = ""
+
+    for line in lines:
+        while len(line) > max_length:
+            if current:
+                pieces.append(current)
+                current = ""
+
+            pieces.append(line[:max_length])
+            line = line[max_length:]
+
+        if current and len(current) + 1 + len(line) > max_length:
+            pieces.append(current)
+            current = line
+        else:
+            current = current + "\n" + line if current else line
+
+    if current:
+        pieces.append(current)
+
+    if fence:
+        pieces = [fence + "\n" + piece + "\n" + CODE_FENCE for piece in pieces]
+
+    return pieces
+
+
+def split_message(text, max_length=MessageLimit.MAX_TEXT_LENGTH):
+    """Splits text into messages at paragraph and code block boundaries.
+
+    Code blocks longer than a message are split by lines and every piece is wrapped
+    in its own fences, so each message stays valid Markdown.
+    """
+    if len(text) <= max_length:
+        return [text]
+
+    parts = []
+    current = ""
+
+    for block in split_into_blocks(text):
+        pieces = [block] if len(block) <= max_length else split_long_block(block, max_length)
+
+        for piece in pieces:
+            if current and len(current) + 2 + len(piece) > max_length:
+                parts.append(current)
+                current = piece
+            else:
+                current = current + "\n\n" + piece if current else piece
+
+    if current:
+        parts.append(current)
+
+    return parts
+
+
+async def send_text(bot, chat_id, text, placeholder=None, parse_mode=None):
+    # the placeholder shown while a request is processed becomes the first message of the answer
+    if placeholder:
+        return await placeholder.edit_text(text=text, parse_mode=parse_mode)
+
+    return await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+
+async def send_markdown_message(bot, chat_id, text, placeholder=None):
+    try:
+        await send_text(bot, chat_id, text, placeholder, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as ex:
+        if "parse entities" not in str(ex):
+            raise
+
+        await send_text(bot, chat_id, text, placeholder)
+
+
+async def send_response(bot, chat_id, text, max_messages=3, placeholder=None):
+    """Sends a response as one or several messages, or as a text document if it is longer.
+
+    If a placeholder message is given, it is edited into the first message instead of
+    sending a new one.
+    """
+    parts = split_message(text)
+
+    if len(parts) <= max_messages:
+        for index, part in enumerate(parts):
+            await send_markdown_message(bot, chat_id, part, placeholder if index == 0 else None)
+
+        return
+
+    document = InputFile(io.BytesIO(text.encode("utf-8")), filename="response.txt")
+    caption = "Ответ слишком длинный, поэтому записал его в текстовый файл"
+
+    if placeholder:
+        await placeholder.edit_text(text=caption)
+
+        caption = None
+
+    await bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        caption=caption
+    )
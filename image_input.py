@@ -0,0 +1,116 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# images up to this size are sent with low detail, which costs a fixed small number of tokens
+LOW_DETAIL_SIZE = 512
+
+
+def choose_photo_size(photo_sizes, detail_target):
+    """Returns the smallest photo size whose shorter side reaches detail_target, or the largest one."""
+    ordered = sorted(photo_sizes, key=lambda photo_size: photo_size.width * photo_size.height)
+
+    for photo_size in ordered:
+        if min(photo_size.width, photo_size.height) >= detail_target:
+            return photo_size
+
+    return ordered[-1]
+
+
+class ImageInput():
+    """Turns photo messages into the content of one multimodal chat message.
+
+    The content keeps the file_id of each photo, since download links contain the bot
+    token and expire, and resolve_messages turns them into links for each request.
+    File paths resolved with getFile are cached by file_id for file_path_ttl seconds,
+    which is less than the hour Telegram keeps the download links valid.
+    """
+
+    def __init__(self, detail_target=768, file_path_ttl=3000, max_cached_files=10000):
+        self.detail_target = detail_target
+        self.file_path_ttl = file_path_ttl
+        self.max_cached_files = max_cached_files
+        self.file_paths = OrderedDict()
+        self.pending_file_paths = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @property
+    def detail(self):
+        return "low" if self.detail_target <= LOW_DETAIL_SIZE else "high"
+
+    async def get_file_path(self, bot, file_id):
+        entry = self.file_paths.get(file_id)
+
+        if entry is not None:
+            file_path, expires_at = entry
+
+            if expires_at > time.monotonic():
+                self.file_paths.move_to_end(file_id)
+                self.cache_hits += 1
+
+                return file_path
+
+            self.file_paths.pop(file_id)
+
+        # concurrent requests for the same photo share one getFile call
+        if file_id in self.pending_file_paths:
+            return await asyncio.shield(self.pending_file_paths[file_id])
+
+        self.cache_misses += 1
+
+        task = asyncio.ensure_future(bot.get_file(file_id))
+        self.pending_file_paths[file_id] = task
+
+        try:
+            file_path = (await task).file_path
+        finally:
+            self.pending_file_paths.pop(file_id, None)
+
+        self.file_paths[file_id] = (file_path, time.monotonic() + self.file_path_ttl)
+
+        while len(self.file_paths) > self.max_cached_files:
+            self.file_paths.popitem(last=False)
+
+        return file_path
+
+    async def create_content(self, bot, messages):
+        """Creates the content parts of the photos of messages, e.g. all messages of an album."""
+        caption = next((message.caption for message in messages if message.caption), "")
+
+        photo_sizes = [choose_photo_size(message.photo, self.detail_target) for message in messages if message.photo]
+
+        # resolved now, so the request right after finds the paths cached
+        await asyncio.gather(*[self.get_file_path(bot, photo_size.file_id) for photo_size in photo_sizes])
+
+        return [{"type": "text", "text": caption}] + [
+            {"type": "image_url", "image_url": {"file_id": photo_size.file_id, "detail": self.detail}}
+            for photo_size in photo_sizes
+        ]
+
+    async def resolve_part(self, bot, part):
+        if part["type"] != "image_url" or "file_id" not in part["image_url"]:
+            return part
+
+        url = await self.get_file_path(bot, part["image_url"]["file_id"])
+
+        return {"type": "image_url", "image_url": {"url": url, "detail": part["image_url"]["detail"]}}
+
+    async def resolve_messages(self, bot, messages):
+        """Returns chat messages with the file ids of their photos replaced by download links."""
+        async def resolve_message(message):
+            if isinstance(message["content"], str):
+                return message
+
+            content = await asyncio.gather(*[self.resolve_part(bot, part) for part in message["content"]])
+
+            return {**message, "content": list(content)}
+
+        return list(await asyncio.gather(*[resolve_message(message) for message in messages]))
+
+    def get_stats(self):
+        return {
+            "file_path_hits": self.cache_hits,
+            "file_path_misses": self.cache_misses,
+            "cached_file_paths": len(self.file_paths)
+        }
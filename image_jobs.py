@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from response_cache import normalize_prompt
+import metrics
+
+IMAGE_JOB_DURATION = metrics.histogram("image_job_duration_seconds", "Time from queueing an image job until it is done", ["status"])
+
+
+def make_job_key(model, prompt):
+    return hashlib.sha256("\0".join([model, normalize_prompt(prompt)]).encode("utf-8")).hexdigest()
+
+
+class ImageJobQueue():
+    """Generates images in background jobs stored in the image_jobs collection.
+
+    Requests for the same prompt while a job is queued or running are added to that job.
+    Jobs are claimed with a lease, so jobs of a process that stopped are taken over by
+    another worker once started_at is older than lease_timeout.
+
+    deliver(job, url, ex) is called once a job is done, with the url or the exception, and
+    is responsible for every request of the job. Finished jobs are deleted by a TTL index
+    retention seconds after they finished.
+    """
+
+    def __init__(self, collection, generate_image, deliver, workers=4, poll_interval=2, lease_timeout=300, retention=86400):
+        self.collection = collection
+        self.generate_image = generate_image
+        self.deliver = deliver
+        self.worker_count = workers
+        self.poll_interval = poll_interval
+        self.lease_timeout = lease_timeout
+        self.retention = retention
+        self.jobs_available = asyncio.Event()
+        self.workers = []
+        self.current_jobs = set()
+        self.submitted = 0
+        self.merged = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+
+    def create_indexes(self):
+        # only queued and running jobs have an active_key
+        self.collection.create_index("active_key", unique=True, sparse=True)
+        self.collection.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+        # only finished jobs have a finished_at
+        self.collection.create_index("finished_at", expireAfterSeconds=int(self.retention))
+
+    async def submit(self, model, prompt, request: dict):
+        """Queues a request and returns its position in the queue, 0 if its job is running already."""
+        key = make_job_key(model, prompt)
+
+        while True:
+            job = await asyncio.to_thread(
+                self.collection.find_one_and_update,
+                {"active_key": key},
+                {"$push": {"requests": request}},
+                projection={"status": 1, "created_at": 1},
+                return_document=ReturnDocument.AFTER
+            )
+
+            if job is not None:
+                self.merged += 1
+
+                break
+
+            # the TTL index expires documents against UTC
+            now = datetime.now(timezone.utc)
+
+            job = {
+                "active_key": key,
+                "model": model,
+                "prompt": prompt,
+                "status": "queued",
+                "requests": [request],
+                # BSON keeps milliseconds, jobs created in the same one are ordered by _id
+                "created_at": now.replace(microsecond=now.microsecond // 1000 * 1000)
+            }
+
+            try:
+                await asyncio.to_thread(self.collection.insert_one, job)
+            except DuplicateKeyError:
+                # the same prompt was queued at the same time, join that job
+                continue
+
+            self.submitted += 1
+            self.jobs_available.set()
+
+            break
+
+        if job["status"] == "running":
+            return 0
+
+        return await asyncio.to_thread(
+            self.collection.count_documents,
+            {"status": "queued", "$or": [
+                {"created_at": {"$lt": job["created_at"]}},
+                {"created_at": job["created_at"], "_id": {"$lte": job["_id"]}}
+            ]}
+        )
+
+    async def claim(self):
+        now = datetime.now(timezone.utc)
+
+        return await asyncio.to_thread(
+            self.collection.find_one_and_update,
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running", "started_at": {"$lt": now - timedelta(seconds=self.lease_timeout)}}
+            ]},
+            {"$set": {"status": "running", "started_at": now}},
+            sort=[("created_at", ASCENDING), ("_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def finish(self, job, fields):
+        # removing active_key closes the job, later requests start a new one
+        return await asyncio.to_thread(
+            self.collection.find_one_and_update,
+            {"_id": job["_id"]},
+            {"$set": {"finished_at": datetime.now(timezone.utc), **fields}, "$unset": {"active_key": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def run_job(self, job):
+        url = None
+        error = None
+
+        try:
+            generated_image_data = await self.generate_image(job["model"], job["prompt"])
+
+            url = generated_image_data.data[0].url
+        except Exception as ex:
+            error = ex
+
+        if error is None:
+            job = await self.finish(job, {"status": "done", "url": url})
+            self.completed += 1
+        else:
+            job = await self.finish(job, {"status": "failed", "error": "{}: {}".format(type(error).__name__, error)})
+            self.failed += 1
+
+        IMAGE_JOB_DURATION.observe((job["finished_at"] - job["created_at"]).total_seconds(), status=job["status"])
+
+        await self.deliver(job, url, error)
+
+    async def work(self):
+        while True:
+            try:
+                job = await self.claim()
+            except Exception as ex:
+                metrics.report_error("image_jobs", ex)
+
+                job = None
+
+            if job is None:
+                self.jobs_available.clear()
+
+                # jobs queued by other processes are found by polling
+                try:
+                    await asyncio.wait_for(self.jobs_available.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            self.running += 1
+            self.current_jobs.add(job["_id"])
+
+            try:
+                await self.run_job(job)
+            except Exception as ex:
+                metrics.report_error("image_jobs", ex)
+            finally:
+                self.running -= 1
+
+            # a cancelled job stays in current_jobs so that stop() can requeue it
+            self.current_jobs.discard(job["_id"])
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+        self.workers = []
+
+        # interrupted jobs go back to the queue instead of waiting for their lease to expire
+        if self.current_jobs:
+            await asyncio.to_thread(
+                self.collection.update_many,
+                {"_id": {"$in": list(self.current_jobs)}, "status": "running"},
+                {"$set": {"status": "queued"}}
+            )
+
+            self.current_jobs.clear()
+
+    def get_stats(self):
+        return {
+            "submitted": self.submitted,
+            "merged": self.merged,
+            "completed": self.completed,
+            "failed": self.failed,
+            "running": self.running
+        }
@@ -0,0 +1,311 @@
+import asyncio
+import collections
+import sys
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ""
+
+    pairs = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(label_names, label_values)]
+
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter():
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = collections.defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        self.values[tuple(labels[name] for name in self.label_names)] += amount
+
+    def collect(self):
+        yield "# HELP {} {}".format(self.name, self.help_text)
+        yield "# TYPE {} counter".format(self.name)
+
+        for label_values, value in list(self.values.items()):
+            yield "{}{} {}".format(self.name, format_labels(self.label_names, label_values), value)
+
+
+class Histogram():
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # per label values: counts per bucket, sum and count
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.label_names)
+        entry = self.values.get(key)
+
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][index] += 1
+
+                break
+
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def collect(self):
+        yield "# HELP {} {}".format(self.name, self.help_text)
+        yield "# TYPE {} histogram".format(self.name)
+
+        for label_values, (bucket_counts, total, count) in list(self.values.items()):
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+
+                yield "{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.label_names + ("le",), label_values + (bound,)),
+                    cumulative
+                )
+
+            yield "{}_bucket{} {}".format(self.name, format_labels(self.label_names + ("le",), label_values + ("+Inf",)), count)
+            yield "{}_sum{} {}".format(self.name, format_labels(self.label_names, label_values), total)
+            yield "{}_count{} {}".format(self.name, format_labels(self.label_names, label_values), count)
+
+
+class Timer():
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry():
+    """Holds the metrics of the process and renders them in the Prometheus text format.
+
+    Collectors are callables returning {name: value} of gauges that are read when the
+    metrics are scraped, e.g. the get_stats of a component.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = {}
+
+    def register(self, metric):
+        # modules imported twice, e.g. as __main__, get the existing metric
+        return self.metrics.setdefault(metric.name, metric)
+
+    def add_collector(self, prefix, get_stats):
+        self.collectors[prefix] = get_stats
+
+    def render(self):
+        lines = []
+
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.collect())
+
+        for prefix, get_stats in list(self.collectors.items()):
+            try:
+                stats = get_stats()
+            except Exception as ex:
+                print(ex)
+
+                continue
+
+            for name, value in stats.items():
+                lines.extend(render_gauge("{}_{}".format(prefix, name), value))
+
+        return "\n".join(lines) + "\n"
+
+
+def render_gauge(name, value):
+    # nested stats such as {"gpt-4o": 3} become one labelled series per key
+    if isinstance(value, dict):
+        yield "# TYPE {} gauge".format(name)
+
+        for key, item in value.items():
+            if isinstance(item, (int, float)):
+                yield "{}{} {}".format(name, format_labels(("key",), (key,)), item)
+            else:
+                yield '{}{} 1'.format(name, format_labels(("key", "value"), (key, item)))
+    elif isinstance(value, (int, float)):
+        yield "# TYPE {} gauge".format(name)
+        yield "{} {}".format(name, value)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Counter(name, help_text, label_names))
+
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, label_names, buckets))
+
+
+ERRORS = counter("errors_total", "Errors caught by the bot by source and type", ["source", "error"])
+
+
+def report_error(source, ex):
+    print(ex)
+
+    ERRORS.inc(source=source, error=type(ex).__name__)
+
+
+EVENT_LOOP_LAG = histogram(
+    "event_loop_lag_seconds",
+    "How much later than scheduled the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    while True:
+        start = time.perf_counter()
+
+        await asyncio.sleep(interval)
+
+        EVENT_LOOP_LAG.observe(max(0, time.perf_counter() - start - interval))
+
+
+class SamplingProfiler():
+    """Samples the stack of one thread at a fixed interval while it is switched on.
+
+    The result is in the collapsed stack format, one line per stack with its sample
+    count, which flame graph tools read directly.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+
+            self.running = True
+
+        self.samples.clear()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+        return True
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                stack.append("{}:{}".format(frame.f_code.co_filename.rsplit("/", 1)[-1], frame.f_code.co_name))
+                frame = frame.f_back
+
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+    def render(self):
+        return "\n".join("{} {}".format(stack, count) for stack, count in self.samples.most_common()) + "\n"
+
+
+class MetricsServer():
+    """Serves /metrics, /ready if a readiness check is given and, if the profiler is enabled, /profile?seconds=N on a local port."""
+
+    def __init__(self, registry=REGISTRY, listen="127.0.0.1", port=9100, profiler_enabled=False, max_profile_seconds=60, ready=None):
+        self.registry = registry
+        self.ready = ready
+        self.listen = listen
+        self.port = port
+        self.max_profile_seconds = max_profile_seconds
+        self.profiler = SamplingProfiler(threading.get_ident()) if profiler_enabled else None
+
+        # aiohttp is only imported by processes that serve metrics
+        from aiohttp import web
+
+        self.web_application = web.Application()
+        self.web_application.router.add_get("/metrics", self.handle_metrics)
+
+        if self.ready:
+            self.web_application.router.add_get("/ready", self.handle_ready)
+
+        if self.profiler:
+            self.web_application.router.add_get("/profile", self.handle_profile)
+
+    async def handle_metrics(self, request):
+        from aiohttp import web
+
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_ready(self, request):
+        from aiohttp import web
+
+        if not self.ready():
+            return web.Response(status=503, text="starting\n")
+
+        return web.Response(text="ready\n")
+
+    async def handle_profile(self, request):
+        from aiohttp import web
+
+        try:
+            seconds = min(float(request.query.get("seconds", 10)), self.max_profile_seconds)
+        except ValueError:
+            return web.Response(status=400)
+
+        if not self.profiler.start():
+            return web.Response(status=409, text="A profile is already being recorded\n")
+
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiler.stop()
+
+        return web.Response(text=self.profiler.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        from aiohttp import web
+
+        # the profiler samples the thread that runs the event loop
+        if self.profiler:
+            self.profiler.thread_id = threading.get_ident()
+
+        self.runner = web.AppRunner(self.web_application)
+
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+
+        self.lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+        print("Serving metrics on {}:{}/metrics".format(self.listen, self.port))
+
+    async def stop(self):
+        self.lag_task.cancel()
+
+        await self.runner.cleanup()
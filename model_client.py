@@ -0,0 +1,299 @@
+import asyncio
+import random
+import threading
+import time
+from types import SimpleNamespace
+from model_enum import Enum
+from model_router import create_model_router
+from resilience import RetryPolicy, CircuitBreaker, CircuitOpenError, is_transient_error
+import metrics
+
+DEFAULT_FALLBACK_MODELS = {Enum.GPT4O.value: Enum.GPT4O_MINI.value}
+
+MODEL_REQUEST_DURATION = metrics.histogram(
+    "model_request_duration_seconds",
+    "Duration of one model request attempt, until the first chunk when streaming",
+    ["model"]
+)
+MODEL_ERRORS = metrics.counter("model_errors_total", "Failed model request attempts by error type", ["model", "error"])
+MODEL_TOKENS = metrics.counter("model_tokens_total", "Tokens reported by the model API", ["model", "kind"])
+
+
+def parse_fallback_models(value):
+    """Parses "gpt-4o=gpt-4o-mini" into a dict of fallback models, "none" disables fallbacks."""
+    if value is None:
+        return dict(DEFAULT_FALLBACK_MODELS)
+
+    if value.strip().lower() in ["", "none"]:
+        return {}
+
+    return {model: fallback for model, fallback in (item.split("=") for item in value.split(","))}
+
+
+def record_usage(model, response):
+    usage = getattr(response, "usage", None)
+
+    if usage is not None:
+        MODEL_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, kind="prompt")
+        MODEL_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, kind="completion")
+
+
+class ModelClient():
+    """Calls the model backend with a concurrency limit, timeouts and retries per model.
+
+    Transient errors are retried by the retry policy. A circuit breaker per model stops
+    sending requests to a model that keeps failing, so users get an answer quickly
+    instead of waiting for every retry to time out.
+    """
+
+    def __init__(self, backend=None, concurrency_limit=10, request_timeout=60, retry_policy=None, failure_threshold=5,
+                 reset_timeout=30, fallback_models=None, create_backend=None, router=None):
+        # a router spreads requests over several backends behind the call shape of one
+        self.router = router
+        self.backend_instance = router or backend
+        self.create_backend = create_backend
+        self.backend_lock = threading.Lock()
+        self.concurrency_limit = concurrency_limit
+        self.request_timeout = request_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.fallback_models = DEFAULT_FALLBACK_MODELS if fallback_models is None else fallback_models
+        self.semaphores = {}
+        self.circuit_breakers = {}
+        self.retries = {}
+        self.failures = {}
+
+    @property
+    def backend(self):
+        # the OpenAI client is created on first use, or earlier by warm_up() in a thread
+        if self.backend_instance is None:
+            with self.backend_lock:
+                if self.backend_instance is None:
+                    self.backend_instance = self.create_backend()
+
+        return self.backend_instance
+
+    def warm_up(self):
+        if self.router:
+            self.router.warm_up()
+        else:
+            self.backend
+
+    def get_semaphore(self, model):
+        if model not in self.semaphores:
+            self.semaphores[model] = asyncio.Semaphore(self.concurrency_limit)
+
+        return self.semaphores[model]
+
+    def get_circuit_breaker(self, model):
+        if model not in self.circuit_breakers:
+            self.circuit_breakers[model] = CircuitBreaker(model, self.failure_threshold, self.reset_timeout)
+
+        return self.circuit_breakers[model]
+
+    def get_fallback_model(self, model, ex):
+        """Returns the model to answer with instead when model failed with ex, if any."""
+        if isinstance(ex, CircuitOpenError) or is_transient_error(ex):
+            return self.fallback_models.get(model)
+
+        return None
+
+    async def call(self, limited_model, coroutine_function, **kwargs):
+        async with self.get_semaphore(limited_model):
+            return await self.call_with_retries(limited_model, coroutine_function, **kwargs)
+
+    async def call_with_retries(self, limited_model, coroutine_function, **kwargs):
+        circuit_breaker = self.get_circuit_breaker(limited_model)
+        attempt = 0
+
+        while True:
+            circuit_breaker.check()
+
+            start = time.perf_counter()
+
+            try:
+                result = await asyncio.wait_for(coroutine_function(**kwargs), timeout=self.request_timeout)
+            except Exception as ex:
+                MODEL_ERRORS.inc(model=limited_model, error=type(ex).__name__)
+
+                if not circuit_breaker.record_error(ex):
+                    raise
+
+                delay = self.retry_policy.get_delay(attempt, ex)
+
+                if delay is None or circuit_breaker.state == "open":
+                    self.failures[limited_model] = self.failures.get(limited_model, 0) + 1
+
+                    raise
+
+                attempt += 1
+                self.retries[limited_model] = self.retries.get(limited_model, 0) + 1
+
+                await asyncio.sleep(delay)
+
+                continue
+
+            MODEL_REQUEST_DURATION.observe(time.perf_counter() - start, model=limited_model)
+            record_usage(limited_model, result)
+
+            circuit_breaker.record_success()
+
+            return result
+
+    async def chat_completion(self, model, messages):
+        return await self.call(
+            model,
+            self.backend.chat.completions.create,
+            model=model,
+            messages=messages
+        )
+
+    async def stream_chat_completion(self, model, messages):
+        async with self.get_semaphore(model):
+            # only opening the stream is retried, chunks that were already shown can not be taken back
+            stream = await self.call_with_retries(
+                model,
+                self.backend.chat.completions.create,
+                model=model,
+                messages=messages,
+                stream=True,
+                # the last chunk then reports the tokens used
+                stream_options={"include_usage": True}
+            )
+
+            async with asyncio.timeout(self.request_timeout):
+                async for chunk in stream:
+                    record_usage(model, chunk)
+
+                    if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+    async def generate_image(self, model, prompt):
+        return await self.call(
+            model,
+            self.backend.images.generate,
+            model=model,
+            prompt=prompt,
+            n=1,
+            size="1024x1024",
+            quality="standard"
+        )
+
+    async def transcribe(self, audio_file):
+        return await self.call(
+            Enum.WHISPER.value,
+            self.backend.audio.transcriptions.create,
+            model="whisper-1",
+            file=audio_file
+        )
+
+    def get_stats(self):
+        return {
+            "circuit_states": {model: breaker.state for model, breaker in self.circuit_breakers.items()},
+            "retries": dict(self.retries),
+            "failures": dict(self.failures)
+        }
+
+
+class FakeModelBackend():
+    """Offline stand-in for AsyncOpenAI with the same call shape, used for load tests."""
+
+    def __init__(self, min_latency=0.5, max_latency=2.0, response_length=500, chunk_latency=0.02, chunk_length=20):
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.response_length = response_length
+        self.chunk_latency = chunk_latency
+        self.chunk_length = chunk_length
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.images = SimpleNamespace(generate=self.generate_image)
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self.create_transcription))
+
+    async def simulate_latency(self):
+        await asyncio.sleep(random.uniform(self.min_latency, self.max_latency))
+
+    async def create_chat_completion(self, model, messages, stream=False, **kwargs):
+        content = ("Ответ модели {} ".format(model) * self.response_length)[:self.response_length]
+
+        if stream:
+            # the latency range is the time to the first chunk when streaming
+            await self.simulate_latency()
+
+            return self.stream_chunks(content)
+
+        await self.simulate_latency()
+
+        await asyncio.sleep(self.chunk_latency * len(content) / self.chunk_length)
+
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(role="assistant", content=content))]
+        )
+
+    async def stream_chunks(self, content):
+        for index in range(0, len(content), self.chunk_length):
+            await asyncio.sleep(self.chunk_latency)
+
+            yield SimpleNamespace(
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=content[index:index + self.chunk_length]))]
+            )
+
+    async def generate_image(self, model, prompt, **kwargs):
+        await self.simulate_latency()
+
+        return SimpleNamespace(data=[SimpleNamespace(url="https://example.com/fake-image.png")])
+
+    async def create_transcription(self, model, file, **kwargs):
+        await self.simulate_latency()
+
+        return SimpleNamespace(text="Расшифровка голосового сообщения")
+
+
+def create_openai_backend(api_key=None, base_url=None, organization=None, on_response=None):
+    # importing openai takes most of the startup time, so it is only imported here
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    return AsyncOpenAI(
+        organization=organization,
+        api_key=api_key,
+        base_url=base_url,
+        # retries are done by ModelClient, which also knows about the circuit breakers
+        max_retries=0,
+        # lets the router read the rate limit headers of every response
+        http_client=DefaultAsyncHttpxClient(event_hooks={"response": [on_response]}) if on_response else None
+    )
+
+
+def create_model_client(environ):
+    if environ.get("MODEL_BACKEND") == "fake":
+        backend = FakeModelBackend(
+            min_latency=float(environ.get("FAKE_MODEL_MIN_LATENCY", 0.5)),
+            max_latency=float(environ.get("FAKE_MODEL_MAX_LATENCY", 2.0))
+        )
+    else:
+        backend = None
+
+    router = None if backend else create_model_router(environ, create_openai_backend)
+
+    retry_policy = RetryPolicy(
+        max_attempts=int(environ.get("MODEL_RETRY_ATTEMPTS", 3)),
+        base_delay=float(environ.get("MODEL_RETRY_BASE_DELAY", 0.5)),
+        max_delay=float(environ.get("MODEL_RETRY_MAX_DELAY", 8)),
+        max_retry_after=float(environ.get("MODEL_RETRY_MAX_RETRY_AFTER", 30))
+    )
+
+    return ModelClient(
+        backend,
+        create_backend=lambda: create_openai_backend(
+            environ.get("OPENAI_API_KEY"),
+            environ.get("OPENAI_BASE_URL"),
+            environ.get("ORGANIZATION_ID")
+        ),
+        router=router,
+        concurrency_limit=int(environ.get("MODEL_CONCURRENCY_LIMIT", 10)),
+        request_timeout=float(environ.get("MODEL_REQUEST_TIMEOUT", 60)),
+        retry_policy=retry_policy,
+        failure_threshold=int(environ.get("MODEL_CIRCUIT_FAILURE_THRESHOLD", 5)),
+        reset_timeout=float(environ.get("MODEL_CIRCUIT_RESET_TIMEOUT", 30)),
+        fallback_models=parse_fallback_models(environ.get("MODEL_FALLBACKS"))
+    )
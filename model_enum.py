@@ -9,4 +9,6 @@ class Enum(Enum):
     FREE = "Free"
     LITE = "Lite"
     SMART = "Smart"
-    PRO = "Pro"
\ No newline at end of file
+    PRO = "Pro"
+
+CHAT_MODELS = [Enum.GPT4O_MINI.value, Enum.GPT4O.value]
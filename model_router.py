@@ -0,0 +1,327 @@
+import asyncio
+import operator
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+from resilience import CircuitBreaker, CircuitOpenError, is_openai_error, get_retry_after
+import metrics
+
+MODEL_BACKEND_REQUESTS = metrics.counter("model_backend_requests_total", "Model request attempts by backend and outcome", ["backend", "outcome"])
+MODEL_BACKEND_DURATION = metrics.histogram("model_backend_duration_seconds", "Duration of successful model requests by backend", ["backend"])
+
+RESET_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value):
+    """Parses an x-ratelimit-reset header like "1s", "6m0s" or "20ms" into seconds, or None."""
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value or "")
+
+    if not parts:
+        return None
+
+    return sum(float(amount) * RESET_UNITS[unit] for amount, unit in parts)
+
+
+def parse_model_names(value):
+    """Parses "gpt-4o-mini=llama3.1:8b,gpt-4o" into a dict of the names a backend uses for the
+    models of the bot, None if it serves every model under its own name."""
+    if value is None or value.strip() == "":
+        return None
+
+    model_names = {}
+
+    for item in value.split(","):
+        model, _, name = item.strip().partition("=")
+        model_names[model] = name or model
+
+    return model_names
+
+
+class ModelBackend():
+    """One OpenAI compatible API with its rolling latency, error rate and rate limit headroom."""
+
+    def __init__(self, name, create_client, model_names=None, cost=1.0, initial_latency=1.0, smoothing=0.2,
+                 failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.create_client = create_client
+        self.client_instance = None
+        self.client_lock = threading.Lock()
+        self.model_names = model_names
+        self.cost = cost
+        self.smoothing = smoothing
+        self.latency = initial_latency
+        self.error_rate = 0.0
+        self.headroom = 1.0
+        self.paused_until = 0
+        self.in_flight = 0
+        self.healthy = True
+        self.circuit_breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+
+    @property
+    def client(self):
+        if self.client_instance is None:
+            with self.client_lock:
+                if self.client_instance is None:
+                    self.client_instance = self.create_client(self.record_response)
+
+        return self.client_instance
+
+    def serves(self, model):
+        return self.model_names is None or model in self.model_names
+
+    def get_model_name(self, model):
+        return model if self.model_names is None else self.model_names[model]
+
+    def get_score(self):
+        """Expected time until an answer weighted by cost, lower is better."""
+        queueing = self.latency * (1 + self.in_flight)
+
+        return queueing * self.cost / max(1 - self.error_rate, 0.05) / max(self.headroom, 0.05)
+
+    def record_result(self, failed, latency=None):
+        self.error_rate += self.smoothing * ((1 if failed else 0) - self.error_rate)
+
+        if latency is not None:
+            self.latency += self.smoothing * (latency - self.latency)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def record_response(self, response):
+        # called by httpx for every response, streaming ones included
+        fractions = []
+
+        for kind in ["requests", "tokens"]:
+            try:
+                limit = float(response.headers["x-ratelimit-limit-{}".format(kind)])
+                remaining = float(response.headers["x-ratelimit-remaining-{}".format(kind)])
+            except (KeyError, ValueError):
+                continue
+
+            if limit > 0:
+                fractions.append(remaining / limit)
+
+            if remaining <= 0:
+                self.pause(parse_reset_duration(response.headers.get("x-ratelimit-reset-{}".format(kind))) or 1)
+
+        if fractions:
+            self.headroom = min(fractions)
+
+    def get_state(self):
+        if not self.healthy:
+            return "unhealthy"
+
+        if time.monotonic() < self.paused_until:
+            return "rate_limited"
+
+        return self.circuit_breaker.state
+
+
+class ModelRouter():
+    """Sends each model request to one of several OpenAI compatible backends.
+
+    Backends are ranked by their rolling latency times the requests in flight, their error
+    rate, the rate limit headroom reported in x-ratelimit headers and their relative cost.
+    A request that fails with a transient error goes to the next backend at once. Backends
+    that failed in a row are skipped by their circuit breaker, backends that failed the
+    health check until they pass it again, and explore_share of the requests go to another
+    backend so that the ranking notices when a slow backend got faster.
+
+    It has the call shape of AsyncOpenAI, so ModelClient uses it like a single backend.
+    """
+
+    def __init__(self, backends, health_interval=15, health_timeout=5, explore_share=0.05):
+        self.backends = backends
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.explore_share = explore_share
+        self.health_task = None
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.images = SimpleNamespace(generate=self.generate_image)
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self.create_transcription))
+
+    def choose(self, model, excluded=()):
+        now = time.monotonic()
+
+        candidates = [
+            backend for backend in self.backends
+            if backend.serves(model) and backend not in excluded and backend.paused_until <= now
+        ]
+
+        # when every backend failed its health check, trying one beats failing right away
+        candidates = [backend for backend in candidates if backend.healthy] or candidates
+        candidates.sort(key=lambda backend: backend.get_score())
+
+        if len(candidates) > 1 and random.random() < self.explore_share:
+            candidates.insert(0, candidates.pop(random.randrange(1, len(candidates))))
+
+        for backend in candidates:
+            try:
+                backend.circuit_breaker.check()
+            except CircuitOpenError:
+                continue
+
+            return backend
+
+        raise CircuitOpenError(model)
+
+    async def request(self, function_name, model, **kwargs):
+        if not any(backend.serves(model) for backend in self.backends):
+            raise ValueError("No model backend serves {}".format(model))
+
+        tried = []
+        last_error = None
+
+        while True:
+            try:
+                backend = self.choose(model, tried)
+            except CircuitOpenError:
+                # the retries of ModelClient take over once every backend failed
+                if last_error is None:
+                    raise
+
+                raise last_error
+
+            create = operator.attrgetter(function_name)(backend.client)
+            start = time.perf_counter()
+
+            backend.in_flight += 1
+
+            try:
+                result = await create(model=backend.get_model_name(model), **kwargs)
+            except asyncio.CancelledError:
+                # ModelClient cancels requests that take longer than its timeout
+                backend.record_result(True, time.perf_counter() - start)
+                backend.circuit_breaker.record_failure()
+
+                raise
+            except Exception as ex:
+                if not backend.circuit_breaker.record_error(ex):
+                    backend.record_result(False)
+                    MODEL_BACKEND_REQUESTS.inc(backend=backend.name, outcome="rejected")
+
+                    raise
+
+                backend.record_result(True)
+                MODEL_BACKEND_REQUESTS.inc(backend=backend.name, outcome="error")
+
+                if is_openai_error(ex, "RateLimitError"):
+                    backend.pause(get_retry_after(ex) or 1)
+
+                tried.append(backend)
+                last_error = ex
+
+                continue
+            finally:
+                backend.in_flight -= 1
+
+            latency = time.perf_counter() - start
+
+            backend.record_result(False, latency)
+            backend.circuit_breaker.record_success()
+            MODEL_BACKEND_REQUESTS.inc(backend=backend.name, outcome="success")
+            MODEL_BACKEND_DURATION.observe(latency, backend=backend.name)
+
+            return result
+
+    async def create_chat_completion(self, model, **kwargs):
+        return await self.request("chat.completions.create", model, **kwargs)
+
+    async def generate_image(self, model, **kwargs):
+        return await self.request("images.generate", model, **kwargs)
+
+    async def create_transcription(self, model, **kwargs):
+        return await self.request("audio.transcriptions.create", model, **kwargs)
+
+    async def check_health(self, backend):
+        try:
+            await asyncio.wait_for(backend.client.models.list(), timeout=self.health_timeout)
+        except Exception as ex:
+            # a server without a model list still answered
+            if not is_openai_error(ex, "NotFoundError"):
+                if backend.healthy:
+                    print("Model backend {} failed its health check: {}".format(backend.name, ex))
+
+                backend.healthy = False
+
+                return
+
+        if not backend.healthy:
+            print("Model backend {} is healthy again".format(backend.name))
+
+        backend.healthy = True
+
+    async def monitor_health(self):
+        while True:
+            await asyncio.gather(*(self.check_health(backend) for backend in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def warm_up(self):
+        for backend in self.backends:
+            backend.client
+
+    def start(self):
+        if self.health_interval > 0:
+            self.health_task = asyncio.create_task(self.monitor_health())
+
+    async def stop(self):
+        if self.health_task:
+            self.health_task.cancel()
+
+            await asyncio.gather(self.health_task, return_exceptions=True)
+
+            self.health_task = None
+
+    def get_stats(self):
+        return {
+            "backend_state": {backend.name: backend.get_state() for backend in self.backends},
+            "backend_latency_seconds": {backend.name: round(backend.latency, 4) for backend in self.backends},
+            "backend_error_rate": {backend.name: round(backend.error_rate, 4) for backend in self.backends},
+            "backend_headroom": {backend.name: round(backend.headroom, 4) for backend in self.backends},
+            "backend_in_flight": {backend.name: backend.in_flight for backend in self.backends}
+        }
+
+
+def get_backend_prefix(name):
+    return "MODEL_ROUTER_{}_".format(re.sub(r"[^A-Z0-9]", "_", name.upper()))
+
+
+def create_model_router(environ, create_client):
+    """Creates a router over the backends listed in MODEL_ROUTER_BACKENDS, or None if it is unset.
+
+    create_client(api_key, base_url, organization, on_response) creates the client of one backend.
+    """
+    names = [name.strip() for name in environ.get("MODEL_ROUTER_BACKENDS", "").split(",") if name.strip()]
+
+    if not names:
+        return None
+
+    backends = []
+
+    for name in names:
+        prefix = get_backend_prefix(name)
+        base_url = environ.get(prefix + "BASE_URL")
+
+        # a backend without a base url is OpenAI itself and uses its key unless it has its own
+        api_key = environ.get(prefix + "API_KEY", environ.get("OPENAI_API_KEY") if base_url is None else "none")
+
+        backends.append(ModelBackend(
+            name,
+            lambda on_response, api_key=api_key, base_url=base_url, prefix=prefix: create_client(
+                api_key, base_url, environ.get(prefix + "ORGANIZATION_ID"), on_response
+            ),
+            model_names=parse_model_names(environ.get(prefix + "MODELS")),
+            cost=float(environ.get(prefix + "COST", 1)),
+            failure_threshold=int(environ.get("MODEL_CIRCUIT_FAILURE_THRESHOLD", 5)),
+            reset_timeout=float(environ.get("MODEL_CIRCUIT_RESET_TIMEOUT", 30))
+        ))
+
+    return ModelRouter(
+        backends,
+        health_interval=float(environ.get("MODEL_ROUTER_HEALTH_INTERVAL", 15)),
+        health_timeout=float(environ.get("MODEL_ROUTER_HEALTH_TIMEOUT", 5)),
+        explore_share=float(environ.get("MODEL_ROUTER_EXPLORE_SHARE", 0.05))
+    )
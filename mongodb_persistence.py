@@ -1,16 +1,141 @@
-from pymongo import MongoClient
+import asyncio
+import logging
+import random
+import time
+import uuid
+from datetime import date
+from user_state import UserState, QUOTA_FIELDS, PERSISTENT_FIELDS, parse_bson_value, fields_to_bson
+import metrics
+from collections import OrderedDict
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
 from telegram.ext import BasePersistence, PersistenceInput
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# version conflicts are retried until the write lands, with a warning after this many in a row
+VERSION_CONFLICT_WARNING = 3
+VERSION_CONFLICT_MAX_DELAY = 1
+
+logger = logging.getLogger(__name__)
+
+USER_PROJECTION = {field: 1 for field in PERSISTENT_FIELDS}
+
+PERSISTENCE_DURATION = metrics.histogram(
+    "persistence_operation_duration_seconds",
+    "Duration of MongoDB operations of the persistence",
+    ["operation"]
+)
+FLUSH_DURATION = metrics.histogram("persistence_flush_duration_seconds", "Duration of one batched write", ["collection"])
+FLUSH_BATCH_SIZE = metrics.histogram(
+    "persistence_flush_batch_size",
+    "Users written by one batched write",
+    ["collection"],
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 5000)
+)
+
+MONGO_CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS"
+}
+
+
+def create_mongo_client(environ):
+    """Creates the MongoClient with the pool size and timeouts set in the environment."""
+    options = {
+        option: int(environ[variable])
+        for variable, option in MONGO_CLIENT_OPTIONS.items()
+        if environ.get(variable)
+    }
+
+    return MongoClient(environ.get("MONGO_DB_URI"), **options)
+
+
+def assign_message_ids(messages):
+    """Gives every message without one an id, which shared mode matches turns by."""
+    for message in messages:
+        if "id" not in message:
+            message["id"] = uuid.uuid4().hex
+
+    return messages
+
+
+def merge_conversation(loaded_messages, messages, stored_messages):
+    """Puts the turns added to a history since loaded_messages into stored_messages, the
+    history another worker wrote meanwhile.
+
+    Turns are matched by id, so a repeated text is still a turn of its own. Turns added in
+    front of the loaded ones, like the summary of ConversationWindow, stay in front, and
+    loaded turns that were dropped are dropped from the stored history as well.
+    """
+    loaded_ids = {message["id"] for message in loaded_messages if "id" in message}
+    kept_ids = {message["id"] for message in messages if message.get("id") in loaded_ids}
+
+    first_kept = next((index for index, message in enumerate(messages) if message.get("id") in loaded_ids), 0)
+
+    leading_messages = messages[:first_kept]
+    trailing_messages = [message for message in messages[first_kept:] if message.get("id") not in loaded_ids]
+    stored_messages = [message for message in stored_messages if message.get("id") not in loaded_ids - kept_ids]
+
+    return leading_messages + stored_messages + trailing_messages
+
+
+def create_index(collection, keys, **kwargs):
+    try:
+        collection.create_index(keys, **kwargs)
+    except (DuplicateKeyError, OperationFailure) as ex:
+        # e.g. duplicate users written before the index existed
+        print(ex)
+
+        if kwargs.pop("unique", False):
+            collection.create_index(keys, **kwargs)
+
+
+def create_user_indexes(db):
+    """Creates the indexes of the user collections, which does nothing if they exist already."""
+    create_index(db.users, "telegram_id", unique=True)
+    create_index(db.users, [("subscription", ASCENDING), ("last_free_request_date", ASCENDING)])
+    create_index(db.users, [("subscription", ASCENDING), ("subscription_expiry_date", ASCENDING)])
+    create_index(db.conversations, "telegram_id", unique=True)
+
 class MongoDBPersistence(BasePersistence):
 
-    def __init__(self, mongo_client: MongoClient):
-        super().__init__(update_interval=600)
+    def __init__(self, mongo_client: MongoClient, write_behind=False, flush_size=500, flush_interval=60,
+                 lazy=False, max_cached_users=10000, cache_ttl=3600, shared=False, is_user_busy=None,
+                 today=date.today, database="user_database"):
+        super().__init__(update_interval=flush_interval if write_behind or shared else 600)
         self.mongo_client = mongo_client
-        self.db = self.mongo_client.user_database
+        # shared mode writes every user with its own versioned update, so it never batches
+        self.write_behind = write_behind and not shared
+        self.shared = shared
+        self.user_versions = {}
+        self.conversation_versions = {}
+        self.loaded_fields = {}
+        self.written_states = {}
+        self.flush_size = flush_size
+        self.pending_updates = {}
+        self.pending_conversations = {}
+        self.flushing_batches = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.lazy = lazy
+        self.max_cached_users = max_cached_users
+        self.cache_ttl = cache_ttl
+        self.cached_users = OrderedDict()
+        self.dirty_user_ids = set()
+        # users whose updates are still being handled keep their state in memory
+        self.is_user_busy = is_user_busy or (lambda user_id: False)
+        # new users start their quota on the date of the quota calendar
+        self.today = today
+        self.db = self.mongo_client[database]
         self.users_collection = self.db.users
+        self.conversations_collection = self.db.conversations
 
         store_data = {
             'user_data': True,
@@ -21,44 +146,333 @@ class MongoDBPersistence(BasePersistence):
         
         self.store_data = PersistenceInput(**store_data)
     
+    def create_indexes(self):
+        create_user_indexes(self.db)
+
     async def get_user_data(self):
         user_data = {}
 
-        for user in self.users_collection.find():
-            user_data[user["telegram_id"]] = {
-                "current_model": user.get("current_model"),
-                "gpt-4o-mini": user.get("gpt-4o-mini"),
-                "gpt-4o": user.get("gpt-4o"),
-                "dall-e-3": user.get("dall-e-3"),
-                "whisper": user.get("whisper"),
-                "subscription": user.get("subscription", "Free"),
-                "last_free_request_date": user.get("last_free_request_date"),
-                "subscription_expiry_date": user.get("subscription_expiry_date")
-            }
+        if self.lazy or self.shared:
+            return user_data
+
+        for user in self.users_collection.find({}, {"telegram_id": 1, **USER_PROJECTION}):
+            user_data[user["telegram_id"]] = UserState.from_bson(user)
 
         return user_data
     
-    async def update_user_data(self, user_id, data: dict):
+    async def update_user_data(self, user_id, data: UserState):
         if user_id:
-            if "messages" in data.keys():
-                data.pop("messages")
+            self.dirty_user_ids.discard(user_id)
+
+            # the user was evicted and persisted after this update had been queued
+            if len(data) == 0:
+                return
+
+            messages = data.pop("messages", None)
             
             if "chosen_premium" in data.keys():
                 data.pop("chosen_premium")
 
-            self.users_collection.update_one(              
+            # quotas are only written through the atomic updates of QuotaEngine
+            for field in QUOTA_FIELDS:
+                data.pop(field, None)
+
+            if self.write_behind:
+                self.pending_updates[user_id] = data
+
+                if messages is not None:
+                    self.pending_conversations[user_id] = messages
+
+                if len(self.pending_updates) >= self.flush_size:
+                    await self.flush()
+                else:
+                    self.schedule_flush()
+
+                return
+
+            if messages is not None and self.conversation_changed(user_id, messages):
+                with PERSISTENCE_DURATION.time(operation="update_conversation"):
+                    if self.shared:
+                        await self.update_shared_conversation(user_id, messages)
+                    else:
+                        await asyncio.to_thread(
+                            self.conversations_collection.update_one,
+                            {"telegram_id": user_id},
+                            {"$set": {"messages": messages}},
+                            upsert=True
+                        )
+
+            if self.shared:
+                await self.update_shared_user_data(user_id, data)
+
+                return
+
+            fields = data.to_bson(dirty_only=True)
+
+            if len(fields) > 0:
+                with PERSISTENCE_DURATION.time(operation="update_user"):
+                    await asyncio.to_thread(
+                        self.users_collection.update_one,
+                        {"telegram_id": user_id},
+                        {"$set": fields},
+                        upsert=True
+                    )
+
+                self.written_states[user_id] = data
+        else:
+            await asyncio.to_thread(self.users_collection.update_many, data)
+
+    def conversation_changed(self, user_id, messages):
+        # in shared mode an unchanged, possibly outdated history must not overwrite a newer one
+        if not self.shared:
+            return True
+
+        return self.loaded_fields.get(user_id, {}).get("messages") != messages
+
+    async def write_conversation_version(self, user_id, messages, version):
+        """Writes the history if it is still at version, which is None for a history without one."""
+        result = await asyncio.to_thread(
+            self.conversations_collection.update_one,
+            {"telegram_id": user_id, "version": version},
+            {"$set": {"messages": messages}, "$inc": {"version": 1}}
+        )
+
+        if result.matched_count == 1:
+            return True
+
+        if version is not None:
+            return False
+
+        try:
+            await asyncio.to_thread(
+                self.conversations_collection.insert_one,
+                {"telegram_id": user_id, "messages": messages, "version": 1}
+            )
+        except DuplicateKeyError:
+            # another worker created the history first
+            return False
+
+        return True
+
+    async def wait_after_conflict(self, description, conflicts):
+        if conflicts == VERSION_CONFLICT_WARNING:
+            logger.warning("%s had %d version conflicts in a row, retrying", description, conflicts)
+
+        # every conflict means another worker's write landed, so the retries make progress
+        await asyncio.sleep(random.uniform(0, min(VERSION_CONFLICT_MAX_DELAY, 0.01 * 2 ** conflicts)))
+
+    async def update_shared_conversation(self, user_id, messages):
+        """Writes the history if no other worker wrote it since the last refresh.
+
+        On a version conflict the turns added since the refresh are merged into the stored
+        history and the write is retried on its version until it lands.
+        """
+        loaded_fields = self.loaded_fields.setdefault(user_id, {})
+        loaded_messages = loaded_fields.get("messages", [])
+        conflicts = 0
+
+        while True:
+            version = self.conversation_versions.get(user_id)
+
+            assign_message_ids(messages)
+
+            if await self.write_conversation_version(user_id, messages, version):
+                self.conversation_versions[user_id] = (version or 0) + 1
+                loaded_fields["messages"] = list(messages)
+
+                return
+
+            conversation = await asyncio.to_thread(
+                self.conversations_collection.find_one,
                 {"telegram_id": user_id},
-                {"$set": data},
-                upsert=True
+                {"messages": 1, "version": 1}
             )
-        else:
-            self.users_collection.update_many(data)
+
+            stored_messages = conversation["messages"] if conversation else []
+
+            self.conversation_versions[user_id] = conversation.get("version") if conversation else None
+            messages = merge_conversation(loaded_messages, messages, stored_messages)
+            loaded_messages = stored_messages
+
+            conflicts += 1
+
+            await self.wait_after_conflict("Conversation of user {}".format(user_id), conflicts)
+
+    async def update_shared_user_data(self, user_id, data: UserState):
+        """Writes the fields changed since the last refresh if no other worker wrote the user meanwhile.
+
+        On a version conflict the fields another worker changed are left to that worker
+        and the remaining changes are retried on the new version until they land.
+        """
+        loaded_fields = self.loaded_fields.setdefault(user_id, {})
+
+        changed_fields = {
+            field: value for field, value in data.items()
+            if field not in loaded_fields or loaded_fields[field] != value
+        }
+
+        conflicts = 0
+
+        while True:
+            if len(changed_fields) == 0:
+                return
+
+            version = self.user_versions.get(user_id)
+
+            # a missing version field also matches None
+            result = await asyncio.to_thread(
+                self.users_collection.update_one,
+                {"telegram_id": user_id, "version": version},
+                {"$set": fields_to_bson(changed_fields), "$inc": {"version": 1}}
+            )
+
+            if result.matched_count == 1:
+                self.user_versions[user_id] = (version or 0) + 1
+                loaded_fields.update(changed_fields)
+
+                return
+
+            user = await asyncio.to_thread(
+                self.users_collection.find_one,
+                {"telegram_id": user_id},
+                {field: 1 for field in list(changed_fields.keys()) + ["version"]}
+            )
+
+            if user == None:
+                return
+
+            self.user_versions[user_id] = user.get("version")
+
+            for field in list(changed_fields.keys()):
+                if field in loaded_fields and parse_bson_value(field, user.get(field)) != loaded_fields[field]:
+                    changed_fields.pop(field)
+
+            conflicts += 1
+
+            await self.wait_after_conflict("User {}".format(user_id), conflicts)
+
+    def schedule_flush(self):
+        # update_persistence hands every dirty user over in one gather, so a flush
+        # scheduled behind them writes the whole pass as a single batch
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
     
     async def drop_user_data(self, user_id: int):
-        self.users_collection.delete_one({"telegram_id": user_id})
+        self.pending_updates.pop(user_id, None)
+        self.pending_conversations.pop(user_id, None)
+        self.user_versions.pop(user_id, None)
+        self.conversation_versions.pop(user_id, None)
+        self.loaded_fields.pop(user_id, None)
+        self.written_states.pop(user_id, None)
 
-    async def refresh_user_data(self, user_id: int, user_data: dict):
-        pass
+        await asyncio.to_thread(self.users_collection.delete_one, {"telegram_id": user_id})
+        await asyncio.to_thread(self.conversations_collection.delete_one, {"telegram_id": user_id})
+
+    async def refresh_user_data(self, user_id: int, user_data: UserState):
+        # fields written since the last update no longer need to be written
+        written_state = self.written_states.pop(user_id, None)
+
+        if written_state is not None:
+            user_data.mark_clean(written_state)
+
+        # in shared mode other workers may have changed the user since the last update
+        if len(user_data) == 0 or self.shared:
+            projection = {**USER_PROJECTION, "version": 1} if self.shared else USER_PROJECTION
+
+            with PERSISTENCE_DURATION.time(operation="load_user"):
+                user = await asyncio.to_thread(self.users_collection.find_one, {"telegram_id": user_id}, projection)
+
+            if user == None:
+                user = {"telegram_id": user_id, **UserState.create_new(self.today()).to_bson()}
+
+                try:
+                    await asyncio.to_thread(self.users_collection.insert_one, dict(user))
+                except DuplicateKeyError:
+                    # another worker created the user first
+                    user = await asyncio.to_thread(self.users_collection.find_one, {"telegram_id": user_id}, projection)
+
+            user_data.load_bson(user)
+
+            # an evicted user may come back before its batch is written
+            unwritten_state = self.get_unwritten("pending_updates", user_id)
+
+            if unwritten_state is not None:
+                for field in unwritten_state:
+                    user_data[field] = unwritten_state[field]
+
+            if self.shared:
+                self.user_versions[user_id] = user.get("version")
+                self.loaded_fields[user_id] = {field: user_data[field] for field in PERSISTENT_FIELDS}
+
+        unwritten_messages = self.get_unwritten("pending_conversations", user_id)
+
+        if "messages" not in user_data and unwritten_messages is not None:
+            user_data["messages"] = list(unwritten_messages)
+
+        if "messages" not in user_data or self.shared:
+            with PERSISTENCE_DURATION.time(operation="load_conversation"):
+                conversation = await asyncio.to_thread(
+                    self.conversations_collection.find_one,
+                    {"telegram_id": user_id},
+                    {"messages": 1, "version": 1}
+                )
+
+            user_data["messages"] = conversation["messages"] if conversation else []
+
+            if self.shared:
+                # histories written before shared mode get the ids that turns are merged by
+                assign_message_ids(user_data["messages"])
+
+                self.conversation_versions[user_id] = conversation.get("version") if conversation else None
+                self.loaded_fields[user_id]["messages"] = list(user_data["messages"])
+
+        if not self.lazy:
+            return
+
+        self.cached_users[user_id] = (user_data, time.monotonic())
+        self.cached_users.move_to_end(user_id)
+        self.dirty_user_ids.add(user_id)
+
+        await self.evict_expired_users(user_id)
+
+    async def evict_expired_users(self, current_user_id=None):
+        expiry_time = time.monotonic() - self.cache_ttl
+
+        for user_id, (user_data, last_access) in list(self.cached_users.items()):
+            if len(self.cached_users) <= self.max_cached_users and last_access > expiry_time:
+                break
+
+            # a running handler would find its user_data cleared
+            if user_id == current_user_id or self.is_user_busy(user_id):
+                continue
+
+            # another eviction may have taken the user while this one was writing
+            if self.cached_users.pop(user_id, None) is None:
+                continue
+
+            await self.evict_user_data(user_id, user_data)
+
+    def get_unwritten(self, pending_attribute, user_id):
+        """Returns what a batch write still has to write of a user, or None."""
+        value = getattr(self, pending_attribute).get(user_id)
+
+        if value is None:
+            value = self.flushing_batches.get(pending_attribute, {}).get(user_id)
+
+        return value
+
+    async def evict_user_data(self, user_id: int, user_data: UserState):
+        """Persists a dirty user before its data is dropped from the working set."""
+        if user_id in self.dirty_user_ids:
+            await self.update_user_data(user_id, user_data.copy())
+
+        # the emptied state is reloaded by refresh_user_data on the next access
+        user_data.clear()
+
+        self.user_versions.pop(user_id, None)
+        self.conversation_versions.pop(user_id, None)
+        self.loaded_fields.pop(user_id, None)
+        self.written_states.pop(user_id, None)
 
     async def get_chat_data(self):
         pass
@@ -82,7 +496,55 @@ class MongoDBPersistence(BasePersistence):
         pass
 
     async def flush(self):
-        pass
+        async with self.flush_lock:
+            await self.flush_batch(self.users_collection, "pending_updates", lambda data: data.to_bson(dirty_only=True))
+            await self.flush_batch(self.conversations_collection, "pending_conversations", lambda messages: {"messages": messages})
+
+    async def flush_batch(self, collection, pending_attribute, get_fields):
+        batch = getattr(self, pending_attribute)
+
+        if len(batch) == 0:
+            return
+
+        setattr(self, pending_attribute, {})
+
+        # users reloaded while the batch is written read it from here
+        self.flushing_batches[pending_attribute] = batch
+
+        try:
+            await self.write_batch(collection, pending_attribute, batch, get_fields)
+        finally:
+            self.flushing_batches.pop(pending_attribute, None)
+
+    async def write_batch(self, collection, pending_attribute, batch, get_fields):
+        operations = []
+
+        for user_id, value in batch.items():
+            fields = get_fields(value)
+
+            if len(fields) > 0:
+                operations.append(UpdateOne({"telegram_id": user_id}, {"$set": fields}, upsert=True))
+
+        if len(operations) == 0:
+            return
+
+        FLUSH_BATCH_SIZE.observe(len(operations), collection=collection.name)
+
+        try:
+            with FLUSH_DURATION.time(collection=collection.name):
+                await asyncio.to_thread(collection.bulk_write, operations, ordered=False)
+        except Exception as ex:
+            print(ex)
+
+            pending = getattr(self, pending_attribute)
+
+            for user_id, value in batch.items():
+                pending.setdefault(user_id, value)
+
+            return
+
+        if collection is self.users_collection:
+            self.written_states.update(batch)
 
     async def get_callback_data(self):
         pass
@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.write_concern import WriteConcern
+from model_enum import Enum
+from quota import get_subscription_expiry_date
+from user_state import UNLIMITED, parse_bson_value, fields_to_bson
+
+PLAN_QUOTAS = {
+    Enum.LITE.value: {Enum.GPT4O_MINI.value: UNLIMITED, Enum.GPT4O.value: 25, Enum.DALLE3.value: 25, Enum.WHISPER.value: UNLIMITED},
+    Enum.SMART.value: {Enum.GPT4O_MINI.value: UNLIMITED, Enum.GPT4O.value: 50, Enum.DALLE3.value: 50, Enum.WHISPER.value: UNLIMITED},
+    Enum.PRO.value: {Enum.GPT4O_MINI.value: UNLIMITED, Enum.GPT4O.value: 100, Enum.DALLE3.value: 50, Enum.WHISPER.value: UNLIMITED}
+}
+
+INVOICE_PAYLOAD_PREFIX = "Bot-Subscription-"
+
+
+def get_plan(invoice_payload):
+    """Returns the plan of an invoice payload like "Bot-Subscription-Smart", or None."""
+    if not invoice_payload or not invoice_payload.startswith(INVOICE_PAYLOAD_PREFIX):
+        return None
+
+    plan = invoice_payload[len(INVOICE_PAYLOAD_PREFIX):]
+
+    return plan if plan in PLAN_QUOTAS else None
+
+
+def get_plan_fields(plan, today):
+    return {**PLAN_QUOTAS[plan], "subscription": plan, "subscription_expiry_date": get_subscription_expiry_date(today)}
+
+
+class PaymentLedger():
+    """Records successful payments in the payments collection before the subscription is granted.
+
+    Entries are keyed by telegram_payment_charge_id, so a payment delivered twice is
+    recorded and applied once. The entry holds the fields the payment grants; it is
+    marked applied after they are written to the user, and entries that a restart left
+    unapplied are applied by reconcile().
+    """
+
+    def __init__(self, payments_collection, quota_engine):
+        # a payment is only confirmed to the user once a majority of the replica set has it
+        self.payments_collection = payments_collection.with_options(write_concern=WriteConcern(w="majority"))
+        self.quota_engine = quota_engine
+
+    def create_indexes(self):
+        self.payments_collection.create_index([("applied", ASCENDING), ("paid_at", ASCENDING)])
+
+    async def record(self, user_id, payment, today):
+        """Stores a SuccessfulPayment and returns its entry, or the existing one if it was recorded before."""
+        plan = get_plan(payment.invoice_payload)
+
+        if plan is None:
+            raise ValueError("Unknown invoice payload: {}".format(payment.invoice_payload))
+
+        entry = {
+            "_id": payment.telegram_payment_charge_id,
+            "user_id": user_id,
+            "plan": plan,
+            "currency": payment.currency,
+            "total_amount": payment.total_amount,
+            "provider_payment_charge_id": payment.provider_payment_charge_id,
+            "fields": fields_to_bson(get_plan_fields(plan, today)),
+            "paid_at": datetime.now(),
+            "applied": False
+        }
+
+        try:
+            await asyncio.to_thread(self.payments_collection.insert_one, entry)
+        except DuplicateKeyError:
+            entry = await asyncio.to_thread(self.payments_collection.find_one, {"_id": entry["_id"]})
+
+        return entry
+
+    async def apply(self, entry, user_data):
+        """Grants the subscription of an entry unless it was applied already. Returns whether it was applied now."""
+        if entry["applied"]:
+            return False
+
+        fields = {field: parse_bson_value(field, value) for field, value in entry["fields"].items()}
+
+        await self.quota_engine.grant(entry["user_id"], user_data, fields)
+
+        await asyncio.to_thread(
+            self.payments_collection.update_one,
+            {"_id": entry["_id"]},
+            {"$set": {"applied": True, "applied_at": datetime.now()}}
+        )
+
+        return True
+
+    def reconcile(self):
+        """Applies all unapplied entries in one bulk write, oldest first, and returns them.
+
+        It runs at startup while users are being loaded, so it writes the collections directly
+        and the caller updates users that are in memory already.
+        """
+        entries = list(self.payments_collection.find({"applied": False}).sort("paid_at", ASCENDING))
+
+        if not entries:
+            return entries
+
+        self.quota_engine.users_collection.bulk_write([
+            UpdateOne({"telegram_id": entry["user_id"]}, {"$set": entry["fields"]}, upsert=True)
+            for entry in entries
+        ], ordered=True)
+
+        self.payments_collection.update_many(
+            {"_id": {"$in": [entry["_id"] for entry in entries]}},
+            {"$set": {"applied": True, "applied_at": datetime.now()}}
+        )
+
+        return entries
@@ -0,0 +1,253 @@
+import asyncio
+import time
+import calendar
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from model_enum import Enum
+from user_state import UNLIMITED, QUOTA_FIELDS, parse_bson_value, to_bson_value, fields_to_bson
+
+DAILY_FREE_REQUESTS = 5
+
+RESET_FIELDS = QUOTA_FIELDS + ["subscription", "last_free_request_date", "subscription_expiry_date"]
+
+
+def get_free_tier_fields(today):
+    return {
+        "subscription": Enum.FREE.value,
+        "last_free_request_date": today,
+        "subscription_expiry_date": None,
+        Enum.GPT4O_MINI.value: DAILY_FREE_REQUESTS,
+        Enum.GPT4O.value: 0,
+        Enum.DALLE3.value: 0,
+        Enum.WHISPER.value: 0
+    }
+
+
+def get_subscription_expiry_date(today):
+    """A subscription lasts until the same day of the next month, or its last day if that is shorter."""
+    year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+
+    return today.replace(year=year, month=month, day=min(today.day, calendar.monthrange(year, month)[1]))
+
+
+def get_date_query(field, operator, today):
+    # documents written before UserState store dates as ISO strings
+    return {"$or": [
+        {field: {operator: to_bson_value(today)}},
+        {field: {operator: today.isoformat(), "$type": "string"}}
+    ]}
+
+
+def get_expired_query(today):
+    return {"subscription": {"$ne": Enum.FREE.value}, **get_date_query("subscription_expiry_date", "$lte", today)}
+
+
+def get_stale_free_query(today):
+    return {"subscription": Enum.FREE.value, **get_date_query("last_free_request_date", "$lt", today)}
+
+
+class QuotaCalendar():
+    """Current date in the quota timezone, computed again only after the next day boundary."""
+
+    def __init__(self, timezone=None):
+        self.timezone = timezone
+        self.date = None
+        self.refresh_at = 0
+
+    def now(self):
+        return datetime.now(self.timezone)
+
+    def today(self):
+        if time.monotonic() >= self.refresh_at:
+            now = self.now()
+            next_day = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), now.tzinfo)
+
+            self.date = now.date()
+            # checked at least hourly, so a DST change can not delay the new day by much
+            self.refresh_at = time.monotonic() + min((next_day - now).total_seconds(), 3600)
+
+        return self.date
+
+
+class QuotaReservation():
+    def __init__(self, user_id, model, unlimited=False):
+        self.user_id = user_id
+        self.model = model
+        self.unlimited = unlimited
+        self.settled = False
+
+
+class QuotaEngine():
+    """Spends request credits with atomic updates on the users collection.
+
+    A reservation moves one credit of the model into reserved.<model> and stamps
+    reserved_at.<model>. It is either committed once the model has answered or refunded
+    if the request failed. Credits held by a crashed process are returned by
+    recover_reservations once the last reservation of the model is older than
+    reservation_timeout.
+    """
+
+    def __init__(self, users_collection, reservation_timeout=3600):
+        self.users_collection = users_collection
+        self.reservation_timeout = reservation_timeout
+
+    async def reserve(self, user_id, model, user_data):
+        if user_data.get(model) == UNLIMITED:
+            return QuotaReservation(user_id, model, unlimited=True)
+
+        user = await asyncio.to_thread(
+            self.users_collection.find_one_and_update,
+            {"telegram_id": user_id, model: {"$gt": 0}},
+            {"$inc": {model: -1, "reserved." + model: 1}, "$set": {"reserved_at." + model: datetime.now()}},
+            projection={model: 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+        if user == None:
+            user = await asyncio.to_thread(
+                self.users_collection.find_one,
+                {"telegram_id": user_id},
+                {model: 1}
+            )
+
+            if user == None:
+                return None
+
+            user_data[model] = parse_bson_value(model, user.get(model))
+
+            # another process may have granted an unlimited subscription meanwhile
+            if user_data[model] == UNLIMITED:
+                return QuotaReservation(user_id, model, unlimited=True)
+
+            return None
+
+        user_data[model] = parse_bson_value(model, user[model])
+
+        return QuotaReservation(user_id, model)
+
+    async def commit(self, reservation):
+        if reservation.unlimited or reservation.settled:
+            return
+
+        reservation.settled = True
+
+        await asyncio.to_thread(
+            self.users_collection.update_one,
+            {"telegram_id": reservation.user_id},
+            {"$inc": {"reserved." + reservation.model: -1}}
+        )
+
+    async def refund(self, reservation, user_data):
+        if reservation.unlimited or reservation.settled:
+            return
+
+        reservation.settled = True
+
+        user = await asyncio.to_thread(
+            self.users_collection.find_one_and_update,
+            {"telegram_id": reservation.user_id},
+            {"$inc": {reservation.model: 1, "reserved." + reservation.model: -1}},
+            projection={reservation.model: 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+        if user != None:
+            user_data[reservation.model] = parse_bson_value(reservation.model, user.get(reservation.model))
+
+    async def grant(self, user_id, user_data, fields: dict):
+        """Overwrites quota and subscription fields, e.g. on a daily reset or a payment."""
+        user_data.update(fields)
+
+        await asyncio.to_thread(
+            self.users_collection.update_one,
+            {"telegram_id": user_id},
+            {"$set": fields_to_bson(fields)},
+            upsert=True
+        )
+
+    async def recover_reservations(self):
+        """Refunds credits still reserved reservation_timeout after the last reservation of
+        their model, which no running request holds anymore. Returns the number of credits."""
+        cutoff = datetime.now() - timedelta(seconds=self.reservation_timeout)
+        recovered = 0
+
+        for model in QUOTA_FIELDS:
+            users = await asyncio.to_thread(
+                lambda: list(self.users_collection.find(
+                    {"reserved." + model: {"$gt": 0}, "reserved_at." + model: {"$lt": cutoff}},
+                    {"telegram_id": 1, "reserved." + model: 1}
+                ))
+            )
+
+            for user in users:
+                count = user["reserved"][model]
+
+                # a reservation made meanwhile changes the counter or the stamp, and the user is left for the next pass
+                result = await asyncio.to_thread(
+                    self.users_collection.update_one,
+                    {
+                        "telegram_id": user["telegram_id"],
+                        "reserved." + model: count,
+                        "reserved_at." + model: {"$lt": cutoff},
+                        # unlimited quotas have no credits to return
+                        model: {"$gte": 0}
+                    },
+                    {"$inc": {model: count, "reserved." + model: -count}}
+                )
+
+                recovered += count * result.modified_count
+
+        return recovered
+
+    async def reset_daily_quotas(self, today):
+        """Downgrades expired subscriptions and refills free requests of all users at once.
+
+        The queries compare dates as ranges, so they are idempotent if they run again on
+        the same day.
+        """
+        downgraded = await asyncio.to_thread(
+            self.users_collection.update_many,
+            get_expired_query(today),
+            {"$set": fields_to_bson(get_free_tier_fields(today))}
+        )
+
+        refilled = await asyncio.to_thread(
+            self.users_collection.update_many,
+            get_stale_free_query(today),
+            {"$set": fields_to_bson({"last_free_request_date": today, Enum.GPT4O_MINI.value: DAILY_FREE_REQUESTS})}
+        )
+
+        return downgraded.modified_count, refilled.modified_count
+
+    async def reset_user_quota(self, user_id, user_data, today):
+        """Applies the daily reset to one user whose cached data is from an earlier day.
+
+        The bulk reset may already have run and the user may have spent requests since,
+        so the update only applies to a stale document and the result is read back.
+        """
+        if user_data["subscription"] != Enum.FREE.value:
+            query = get_expired_query(today)
+            fields = get_free_tier_fields(today)
+        else:
+            query = get_stale_free_query(today)
+            fields = {"last_free_request_date": today, Enum.GPT4O_MINI.value: DAILY_FREE_REQUESTS}
+
+        projection = {field: 1 for field in RESET_FIELDS}
+
+        user = await asyncio.to_thread(
+            self.users_collection.find_one_and_update,
+            {"telegram_id": user_id, **query},
+            {"$set": fields_to_bson(fields)},
+            projection=projection,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if user == None:
+            user = await asyncio.to_thread(self.users_collection.find_one, {"telegram_id": user_id}, projection)
+
+        if user == None:
+            await self.grant(user_id, user_data, fields)
+
+            return
+
+        user_data.load_bson(user, RESET_FIELDS)
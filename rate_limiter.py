@@ -0,0 +1,136 @@
+import asyncio
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from admission import TokenBucket
+import metrics
+
+BOT_API_RETRIES = metrics.counter("bot_api_retries_total", "Bot API calls retried after a flood limit error", ["method"])
+BOT_API_THROTTLE = metrics.histogram(
+    "bot_api_throttle_seconds",
+    "Time Bot API calls waited for the rate limiter",
+    ["method"],
+    buckets=(0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+
+def get_retry_after_seconds(ex):
+    retry_after = ex.retry_after
+
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Keeps Bot API calls under the Telegram flood limits.
+
+    Calls to a chat take a token from the bucket of the whole bot and from the bucket of
+    the chat, which is slower for groups. A RetryAfter pauses the chat, or every call if it
+    had no chat, for as long as Telegram asks and the call is retried up to max_retries times.
+    """
+
+    def __init__(self, overall_rate=30, chat_rate=1, chat_burst=3, group_rate_per_minute=20, max_retries=2):
+        self.overall_bucket = TokenBucket(overall_rate, overall_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.paused_until = {}
+        self.all_paused_until = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) > 100000:
+                self.prune_chat_buckets()
+
+            # group and channel ids are negative or @usernames
+            is_group = isinstance(chat_id, str) or chat_id < 0
+
+            self.chat_buckets[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+
+        return self.chat_buckets[chat_id]
+
+    def prune_chat_buckets(self):
+        now = time.monotonic()
+
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            bucket.refill()
+
+            if bucket.tokens >= bucket.capacity:
+                self.chat_buckets.pop(chat_id)
+
+        for chat_id, paused_until in list(self.paused_until.items()):
+            if paused_until <= now:
+                self.paused_until.pop(chat_id)
+
+    async def wait_for_capacity(self, chat_id):
+        buckets = [self.overall_bucket, self.get_chat_bucket(chat_id)]
+
+        while True:
+            paused_until = max(self.all_paused_until, self.paused_until.get(chat_id, 0))
+
+            wait = max([paused_until - time.monotonic()] + [bucket.time_until_available() for bucket in buckets])
+
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.try_acquire()
+
+                return
+
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+
+        for attempt in range(max_retries + 1):
+            # only calls to a chat count against the flood limits
+            if chat_id is not None:
+                start = time.perf_counter()
+
+                await self.wait_for_capacity(chat_id)
+
+                BOT_API_THROTTLE.observe(time.perf_counter() - start, method=endpoint)
+            else:
+                await asyncio.sleep(max(0, self.all_paused_until - time.monotonic()))
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as ex:
+                if attempt == max_retries:
+                    raise
+
+                BOT_API_RETRIES.inc(method=endpoint)
+
+                paused_until = time.monotonic() + get_retry_after_seconds(ex)
+
+                if chat_id is None:
+                    self.all_paused_until = max(self.all_paused_until, paused_until)
+                else:
+                    self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0), paused_until)
+
+
+def create_rate_limiter(environ):
+    """Creates the rate limiter of the Bot API client, or None if BOT_RATE_LIMIT_PER_SECOND is 0."""
+    overall_rate = float(environ.get("BOT_RATE_LIMIT_PER_SECOND", 30))
+
+    if overall_rate <= 0:
+        return None
+
+    return TelegramRateLimiter(
+        overall_rate=overall_rate,
+        chat_rate=float(environ.get("BOT_CHAT_RATE_LIMIT_PER_SECOND", 1)),
+        chat_burst=int(environ.get("BOT_CHAT_BURST", 3)),
+        group_rate_per_minute=float(environ.get("BOT_GROUP_RATE_LIMIT_PER_MINUTE", 20)),
+        max_retries=int(environ.get("BOT_FLOOD_RETRIES", 2))
+    )
@@ -0,0 +1,126 @@
+import asyncio
+import random
+import sys
+import time
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, model):
+        super().__init__("Requests to {} are paused after repeated failures".format(model))
+        self.model = model
+
+
+def is_openai_error(ex, name):
+    # openai is imported when the model client is first used, errors before that cannot come from it
+    openai = sys.modules.get("openai")
+
+    return openai is not None and isinstance(ex, getattr(openai, name))
+
+
+def is_transient_error(ex):
+    if isinstance(ex, asyncio.TimeoutError) or is_openai_error(ex, "APIConnectionError") or is_openai_error(ex, "APITimeoutError"):
+        return True
+
+    if is_openai_error(ex, "APIStatusError"):
+        # an exhausted account quota does not recover by retrying
+        if ex.status_code == 429:
+            return getattr(ex, "code", None) != "insufficient_quota"
+
+        return ex.status_code >= 500
+
+    return False
+
+
+def get_retry_after(ex):
+    response = getattr(ex, "response", None)
+
+    if response is None:
+        return None
+
+    value = response.headers.get("retry-after")
+
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RetryPolicy():
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8, max_retry_after=30):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def get_delay(self, attempt, ex):
+        """Returns the delay before the next attempt, or None if the request should not be retried."""
+        if attempt + 1 >= self.max_attempts or not is_transient_error(ex):
+            return None
+
+        retry_after = get_retry_after(ex)
+
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+
+            return retry_after
+
+        # full jitter keeps retries of many failed requests from arriving together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker():
+    """Fails fast after failure_threshold transient failures in a row.
+
+    After reset_timeout seconds a single trial request is let through; its result
+    closes the circuit again or keeps it open for another reset_timeout.
+    """
+
+    def __init__(self, model, failure_threshold=5, reset_timeout=30):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+
+    def check(self):
+        if self.state == "closed":
+            return
+
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.trial_running = False
+
+        if self.state == "half_open" and not self.trial_running:
+            self.trial_running = True
+
+            return
+
+        raise CircuitOpenError(self.model)
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_error(self, ex):
+        """Records a failed request and returns whether the error is transient and worth retrying."""
+        if not is_transient_error(ex):
+            # the model did answer, only this request was wrong
+            self.record_success()
+
+            return False
+
+        self.record_failure()
+
+        return True
@@ -0,0 +1,107 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split()).casefold()
+
+
+class ResponseCache():
+    """Caches model responses of first-turn chats and image prompts.
+
+    The in-memory tier is an LRU bounded by max_entries. If a MongoDB collection is
+    given it is used as a second tier shared by all bot processes, expired by a TTL index.
+
+    A cache hit answers the request like the model would, so it uses up the request
+    credit of the user the same way.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, collection=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.collection = collection
+        self.entries = OrderedDict()
+        self.indexes_created = False
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def make_key(self, model, prompt, context=""):
+        key = "\0".join([model, normalize_prompt(prompt), context])
+
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            value, expires_at = entry
+
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+
+                return value
+
+            self.entries.pop(key)
+
+        if self.collection is not None:
+            # the TTL index expires documents against UTC
+            now = datetime.now(timezone.utc)
+
+            document = await asyncio.to_thread(
+                self.collection.find_one,
+                {"_id": key, "expires_at": {"$gt": now}}
+            )
+
+            if document is not None:
+                self.shared_hits += 1
+
+                # pymongo returns naive UTC datetimes unless the client is tz_aware
+                ttl = (document["expires_at"].replace(tzinfo=timezone.utc) - now).total_seconds()
+                self.set_memory_entry(key, document["value"], ttl)
+
+                return document["value"]
+
+        self.misses += 1
+
+        return None
+
+    async def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        self.set_memory_entry(key, value, ttl)
+
+        if self.collection is None:
+            return
+
+        if not self.indexes_created:
+            await asyncio.to_thread(self.collection.create_index, "expires_at", expireAfterSeconds=0)
+
+            self.indexes_created = True
+
+        await asyncio.to_thread(
+            self.collection.replace_one,
+            {"_id": key},
+            {"value": value, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)},
+            upsert=True
+        )
+
+    def set_memory_entry(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "entries": len(self.entries)
+        }
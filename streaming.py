@@ -0,0 +1,79 @@
+import time
+from telegram.constants import ParseMode, MessageLimit
+from telegram.error import BadRequest
+
+
+class StreamingMessageEditor():
+    """Shows a streamed response by editing a placeholder message.
+
+    Chunks are coalesced and the message is edited at most once per edit_interval to
+    stay under Telegram flood limits. Text beyond the message length limit continues
+    in a new message.
+    """
+
+    def __init__(self, bot, chat_id, message, edit_interval=1.0, max_length=MessageLimit.MAX_TEXT_LENGTH):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = message
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.text = ""
+        self.shown_text = None
+        self.last_edit_time = 0
+        self.first_edit_time = None
+
+    async def append(self, chunk):
+        self.text += chunk
+
+        while len(self.text) > self.max_length:
+            await self.start_continuation()
+
+        if time.monotonic() - self.last_edit_time >= self.edit_interval:
+            await self.edit(self.text)
+
+    async def start_continuation(self):
+        split_index = self.text.rfind("\n", 0, self.max_length)
+
+        if split_index <= 0:
+            split_index = self.max_length
+
+        await self.edit(self.text[:split_index], final=True)
+
+        self.text = self.text[split_index:].lstrip("\n")
+        self.shown_text = None
+        self.message = await self.bot.send_message(chat_id=self.chat_id, text=self.text[:self.max_length] or "...")
+        self.last_edit_time = time.monotonic()
+
+    async def finish(self):
+        if self.text:
+            await self.edit(self.text, final=True)
+
+    async def edit(self, text, final=False):
+        if not text or text == self.shown_text and not final:
+            return
+
+        self.last_edit_time = time.monotonic()
+
+        # partial Markdown is often unbalanced, so only the final text is parsed
+        if final:
+            try:
+                await self.message.edit_text(text=text, parse_mode=ParseMode.MARKDOWN)
+                self.mark_shown(text)
+
+                return
+            except BadRequest as ex:
+                if "not modified" in str(ex):
+                    return
+
+        try:
+            await self.message.edit_text(text=text)
+            self.mark_shown(text)
+        except BadRequest as ex:
+            if "not modified" not in str(ex):
+                raise
+
+    def mark_shown(self, text):
+        self.shown_text = text
+
+        if self.first_edit_time is None:
+            self.first_edit_time = time.monotonic()
@@ -1,48 +1,245 @@
 import os
 import logging
-import utils
-import uuid
+import asyncio
+import tempfile
+import argparse
+import time as time_module
+import multiprocessing
+from copy import deepcopy
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
-from telegram.constants import ParseMode
-from telegram.ext import filters, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler
-from openai import OpenAI, BadRequestError
+from telegram.ext import filters, MessageHandler, ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, PreCheckoutQueryHandler, TypeHandler
 from dotenv import load_dotenv
-from pymongo.mongo_client import MongoClient
 from texts import TextGenerator
-from mongodb_persistence import MongoDBPersistence
-from datetime import datetime
+from mongodb_persistence import MongoDBPersistence, create_mongo_client, create_user_indexes
+from model_client import create_model_client
+from model_enum import CHAT_MODELS
+from update_processor import PerUserUpdateProcessor
+from quota import QuotaEngine, QuotaCalendar, QuotaReservation
+from payments import PaymentLedger, get_plan
+from user_state import UserState
+from conversation import ConversationWindow, parse_token_budgets
+from streaming import StreamingMessageEditor
+from delivery import send_response, send_text, split_message
+from response_cache import ResponseCache
+from admission import AdmissionController, AdmissionRejected, parse_model_limits
+from resilience import CircuitOpenError, is_transient_error, is_openai_error
+from image_input import ImageInput
+from image_jobs import ImageJobQueue
+from bot_request import create_bot_request
+from rate_limiter import create_rate_limiter
+import metrics
+from datetime import time
+from pymongo.errors import PyMongoError
+from zoneinfo import ZoneInfo
+
+# generated image urls expire after an hour
+IMAGE_URL_TTL = 3000
+
+# expected size of a chat response when the token budget of a request is estimated
+RESPONSE_TOKEN_ESTIMATE = 1000
+HANDLER_DURATION = metrics.histogram("handler_duration_seconds", "Duration of update handlers", ["handler", "model"])
+QUOTA_REJECTIONS = metrics.counter("quota_rejections_total", "Requests rejected because the user has no requests left", ["model"])
+
+MODEL_UNAVAILABLE_TEXT = "Модель сейчас перегружена, попробуйте позже. Запрос не списан"
+PAYMENT_NOT_RECORDED_TEXT = "Оплата получена, но подписку пока не удалось оформить. Напишите в поддержку и укажите номер платежа: {}"
+
+# a paid subscription is worth retrying the ledger for well beyond a short database outage
+PAYMENT_RECORD_ATTEMPTS = 6
+PAYMENT_RECORD_BASE_DELAY = 1
+
+# startup checks that failed are retried until they pass, at most this far apart
+BOOT_RETRY_BASE_DELAY = 1
+BOOT_RETRY_MAX_DELAY = 60
 
 class TelegramBot():
-    def __init__(self):
+    def __init__(self, mongo_client=None):
         load_dotenv()
 
-        print("Connecting to the database...")
+        # benchmarks pass an in-memory client, the connection is checked by boot()
+        self.mongo_client = mongo_client or create_mongo_client(os.environ)
 
-        self.mongo_client = MongoClient(os.environ.get("MONGO_DB_URI"))
+        self.ready = asyncio.Event()
+        self.boot_task = None
 
-        self.check_database_connection()
+        self.model_client = create_model_client(os.environ)
 
-        self.openai_client = OpenAI(
-            organization=os.environ.get("ORGANIZATION_ID"),
-            api_key=os.environ.get("OPENAI_API_KEY")
+        self.quota_engine = QuotaEngine(
+            self.mongo_client.user_database.users,
+            reservation_timeout=float(os.environ.get("QUOTA_RESERVATION_TIMEOUT", 3600))
         )
+        self.quota_calendar = create_quota_calendar(os.environ)
+
+        self.conversation_window = ConversationWindow(
+            parse_token_budgets(os.environ.get("CONVERSATION_TOKEN_BUDGETS")),
+            model_client=self.model_client,
+            summarize=os.environ.get("CONVERSATION_SUMMARIZE") == "1"
+        )
+
+        self.stream_responses = os.environ.get("STREAM_RESPONSES") == "1"
+        self.stream_edit_interval = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.0))
+
+        self.max_response_messages = int(os.environ.get("MAX_RESPONSE_MESSAGES", 3))
+
+        self.response_cache = None
+
+        if os.environ.get("RESPONSE_CACHE") == "1":
+            self.response_cache = ResponseCache(
+                max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", 1000)),
+                ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+                collection=self.mongo_client.user_database.response_cache if os.environ.get("RESPONSE_CACHE_SHARED") == "1" else None
+            )
+
+        self.admission_controller = AdmissionController(
+            user_rate_per_minute=float(os.environ.get("RATE_LIMIT_USER_PER_MINUTE", 10)),
+            user_burst=int(os.environ.get("RATE_LIMIT_USER_BURST", 3)),
+            model_rpm_limits=parse_model_limits(os.environ.get("MODEL_RPM_LIMITS"), {
+                "gpt-4o-mini": 500,
+                "gpt-4o": 500,
+                "dall-e-3": 5,
+                "whisper": 50
+            }),
+            model_tpm_limits=parse_model_limits(os.environ.get("MODEL_TPM_LIMITS"), {
+                "gpt-4o-mini": 200000,
+                "gpt-4o": 30000
+            }),
+            max_concurrency=int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 20)),
+            max_queue_size=int(os.environ.get("ADMISSION_QUEUE_SIZE", 100)),
+            max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 30))
+        )
+
+        self.voice_spool_threshold = int(os.environ.get("VOICE_SPOOL_THRESHOLD", 5 * 1024 * 1024))
+        self.transcription_semaphore = asyncio.Semaphore(int(os.environ.get("TRANSCRIPTION_CONCURRENCY_LIMIT", 10)))
 
         self.initialize_logging()
 
-        self.persistence = MongoDBPersistence(self.mongo_client)
+        self.update_processor = PerUserUpdateProcessor(
+            int(os.environ.get("UPDATE_WORKERS", 64)),
+            media_group_wait=float(os.environ.get("MEDIA_GROUP_WAIT", 1.0))
+        )
+
+        self.persistence = MongoDBPersistence(
+            self.mongo_client,
+            write_behind=os.environ.get("PERSISTENCE_WRITE_BEHIND") == "1",
+            flush_size=int(os.environ.get("PERSISTENCE_FLUSH_SIZE", 500)),
+            flush_interval=float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", 60)),
+            lazy=os.environ.get("PERSISTENCE_LAZY", "1") == "1",
+            max_cached_users=int(os.environ.get("PERSISTENCE_MAX_CACHED_USERS", 10000)),
+            cache_ttl=float(os.environ.get("PERSISTENCE_CACHE_TTL", 3600)),
+            shared=os.environ.get("PERSISTENCE_SHARED") == "1",
+            today=self.quota_calendar.today,
+            is_user_busy=self.update_processor.is_user_busy
+        )
+
+        self.image_jobs = ImageJobQueue(
+            self.mongo_client.user_database.image_jobs,
+            self.model_client.generate_image,
+            self.deliver_image_job,
+            workers=int(os.environ.get("IMAGE_JOB_WORKERS", 4)),
+            poll_interval=float(os.environ.get("IMAGE_JOB_POLL_INTERVAL", 2)),
+            lease_timeout=float(os.environ.get("IMAGE_JOB_LEASE_TIMEOUT", 300)),
+            retention=float(os.environ.get("IMAGE_JOB_RETENTION", 86400))
+        )
+
+        self.payment_ledger = PaymentLedger(self.mongo_client.user_database.payments, self.quota_engine)
+
+        self.image_input = ImageInput(
+            detail_target=int(os.environ.get("IMAGE_DETAIL_TARGET", 768)),
+            file_path_ttl=float(os.environ.get("IMAGE_FILE_PATH_TTL", 3000))
+        )
+
+        self.metrics_server = None
+
+        application_builder = ApplicationBuilder().token(os.environ.get("TELEGRAM_BOT_API_KEY")).persistence(self.persistence).concurrent_updates(self.update_processor).context_types(ContextTypes(user_data=UserState)).request(create_bot_request(os.environ)).post_init(self.post_init).post_shutdown(self.post_shutdown)
+
+        rate_limiter = create_rate_limiter(os.environ)
+
+        if rate_limiter:
+            application_builder = application_builder.rate_limiter(rate_limiter)
+
+        # lets load tests point the bot to a local fake Bot API
+        if os.environ.get("TELEGRAM_API_BASE_URL"):
+            application_builder = application_builder.base_url(os.environ.get("TELEGRAM_API_BASE_URL"))
 
-        self.application = ApplicationBuilder().token(os.environ.get("TELEGRAM_BOT_API_KEY")).persistence(self.persistence).build()
+        self.application = application_builder.build()
 
         self.add_handlers()
 
+        if os.environ.get("QUOTA_RESET_JOB", "1") == "1":
+            self.schedule_quota_reset()
+
         self.text_generator = TextGenerator()
     
     def check_database_connection(self):
-        try:
-            self.mongo_client.admin.command('ping')
-            print("Connection established!")
-        except Exception as ex:
-            print(ex)
+        self.mongo_client.admin.command('ping')
+        print("Connection established!")
+
+    def create_indexes(self):
+        self.persistence.create_indexes()
+        self.image_jobs.create_indexes()
+        self.payment_ledger.create_indexes()
+
+    async def reconcile_payments(self):
+        entries = await asyncio.to_thread(self.payment_ledger.reconcile)
+
+        # users loaded before the bulk write get the fields of their payments as well
+        for entry in entries:
+            user_data = self.application.user_data.get(entry["user_id"])
+
+            if user_data:
+                user_data.load_bson(entry["fields"], list(entry["fields"]))
+
+        if entries:
+            print("Applied {} payments from the ledger".format(len(entries)))
+
+    async def run_until_passed(self, steps):
+        """Runs steps concurrently and the failed ones again with exponential backoff until all of them passed."""
+        attempt = 0
+
+        while True:
+            results = await asyncio.gather(*(step() for step in steps), return_exceptions=True)
+
+            failed_steps = []
+
+            for step, result in zip(steps, results):
+                if isinstance(result, Exception):
+                    metrics.report_error("startup", result)
+                    failed_steps.append(step)
+
+            if not failed_steps:
+                break
+
+            steps = failed_steps
+
+            await asyncio.sleep(min(BOOT_RETRY_MAX_DELAY, BOOT_RETRY_BASE_DELAY * 2 ** attempt))
+
+            attempt += 1
+
+    async def boot(self):
+        """Checks the database, creates indexes, applies pending payments and creates the
+        OpenAI client concurrently while the application starts, then sets ready.
+
+        Steps that failed are run again with exponential backoff until all of them passed.
+        """
+        start = time_module.perf_counter()
+
+        steps = [
+            lambda: asyncio.to_thread(self.check_database_connection),
+            self.reconcile_payments,
+            lambda: asyncio.to_thread(self.model_client.warm_up)
+        ]
+
+        # in shared mode post_init created the indexes before the first update
+        if not self.persistence.shared:
+            steps.append(lambda: asyncio.to_thread(self.create_indexes))
+
+        await self.run_until_passed(steps)
+
+        self.ready.set()
+
+        print("Ready after {:.2f}s of checks".format(time_module.perf_counter() - start))
+
+    def is_ready(self):
+        return self.ready.is_set()
     
     def initialize_logging(self):
         logging.basicConfig(
@@ -50,44 +247,24 @@ class TelegramBot():
             level=logging.INFO
         )
     
-    def check_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if len(context.user_data) == 0:
-            db = self.mongo_client.user_database
-
-            user_id = update.effective_user.id
-
-            user = db.users.find_one({"telegram_id": user_id})
-
-            if user == None:
-                user = utils.create_new_user(user_id)
-
-                db.users.insert_one(user)
-
-            utils.create_user_data(context, user)
-        
+    async def check_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if "messages" not in context.user_data:
             context.user_data["messages"] = []
-        
-        if context.user_data["subscription"] != "Free":
-            if datetime.fromisoformat(context.user_data["subscription_expiry_date"]) <= datetime.now():
-                context.user_data["subscription"] = "Free"
-                context.user_data["last_free_request_date"] = datetime.now().date().isoformat()
-                context.user_data["subscription_expiry_date"] = "Безлимит"
-                context.user_data["gpt-4o-mini"] = 5
-                context.user_data["gpt-4o"] = 0
-                context.user_data["dall-e-3"] = 0
-                context.user_data["whisper"] = 0
 
-            return
-        
-        current_date = datetime.now().date().isoformat()
+        # the daily job resets everyone in bulk, this only catches users cached since yesterday
+        today = self.quota_calendar.today()
 
-        if context.user_data["last_free_request_date"] != current_date:
-            context.user_data["last_free_request_date"] = current_date
-            context.user_data["gpt-4o-mini"] = 5
+        if context.user_data["subscription"] != "Free":
+            expiry_date = context.user_data["subscription_expiry_date"]
+            stale = expiry_date is not None and expiry_date <= today
+        else:
+            stale = context.user_data["last_free_request_date"] != today
+
+        if stale:
+            await self.quota_engine.reset_user_quota(update.effective_user.id, context.user_data, today)
 
     async def info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         message = self.text_generator.get_info_text()
 
@@ -97,7 +274,7 @@ class TelegramBot():
         )
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -105,7 +282,7 @@ class TelegramBot():
         )
 
     async def start_new_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         context.user_data["messages"] = []
 
@@ -114,187 +291,329 @@ class TelegramBot():
             text="Новый чат создан. Пишите запросы"
         )
     
-    async def check_message_type(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def check_message_type(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder=None):
         message = update.message.text
 
         if len(update.message.photo) > 0:
-            caption = update.message.caption
-
-            if not caption:
-                caption = ""
-
-            file_id = update.message.photo[-1].file_id
-
-            new_file = await context.bot.get_file(file_id)
+            messages = self.update_processor.get_media_group(update.message)
 
-            url = new_file.file_path
-
-            message = [
-                {"type": "text", "text": caption},
-                {
-                "type": "image_url",
-                "image_url": {"url": url},
-                },
-            ]
+            message = await self.image_input.create_content(context.bot, messages)
         elif update.message.voice:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Эта модель не распознает голосовые сообщения"
-            )
+            await send_text(context.bot, update.effective_chat.id, "Эта модель не распознает голосовые сообщения", placeholder)
 
             message = None
 
         return message
         
-    async def handle_chat_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def handle_chat_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder=None):
         try:
-            message = await self.check_message_type(update, context)
+            message = await self.check_message_type(update, context, placeholder)
 
             if not message:
-                return
-
-            user_id = update.effective_user.id
+                return False
 
             context.user_data["messages"].append({"role": "user", "content": message})
 
-            completion = self.openai_client.chat.completions.create(
-                model=context.user_data["current_model"],
-                messages=context.user_data["messages"],
-            )
+            await self.conversation_window.fit(context.user_data["current_model"], context.user_data["messages"])
 
-            response = completion.choices[0].message.content
+            cache_key = None
+            response = None
 
-            if len(response) > 4096:
-                with open("response{}.txt".format(user_id), "w", encoding="utf-8", errors='ignore') as file:
-                    file.write(response)
-            
-                await context.bot.send_document(
-                    chat_id=update.effective_chat.id,
-                    document=open("response{}.txt".format(user_id), "r", encoding="utf-8", errors="ignore"),
-                    caption="Ответ слишком длинный, поэтому записал его в текстовый файл"
-                )
+            # only first-turn text requests have no context that could change the answer
+            if self.response_cache and len(context.user_data["messages"]) == 1 and isinstance(message, str):
+                cache_key = self.response_cache.make_key(context.user_data["current_model"], message)
 
-                os.remove("response{}.txt".format(user_id))
-            else:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=response,
-                    parse_mode=ParseMode.MARKDOWN
+                response = await self.response_cache.get(cache_key)
+
+            if response is not None:
+                await send_response(
+                    context.bot,
+                    update.effective_chat.id,
+                    response,
+                    max_messages=self.max_response_messages,
+                    placeholder=placeholder
                 )
+            else:
+                model = context.user_data["current_model"]
+
+                try:
+                    response = await self.create_chat_response(update, context, placeholder, model)
+                except Exception as ex:
+                    fallback_model = self.model_client.get_fallback_model(model, ex)
+
+                    if fallback_model is None:
+                        raise
+
+                    metrics.report_error("chat_fallback", ex)
+
+                    response = await self.create_chat_response(update, context, placeholder, fallback_model)
+
+                    context.user_data["messages"].append({"role": "assistant", "content": response})
+
+                    # the user did not get the model they paid for, so the request is not charged
+                    await context.bot.send_message(
+                        chat_id=update.effective_chat.id,
+                        text="Модель {} сейчас недоступна, поэтому ответила {}. Запрос не списан".format(model, fallback_model)
+                    )
+
+                    return False
 
-            context.user_data["messages"].append({"role": "system", "content": response})
+            if cache_key:
+                await self.response_cache.set(cache_key, response)
+
+            context.user_data["messages"].append({"role": "assistant", "content": response})
+
+            return True
         except Exception as ex:
-            print(ex)
+            metrics.report_error("chat", ex)
 
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Что то пошло не так, попробуйте снова. Убедитесь, что вы присылаете текст и/или фотографию не файлом."
-            )
+            if isinstance(ex, CircuitOpenError) or is_transient_error(ex):
+                text = MODEL_UNAVAILABLE_TEXT
+            else:
+                text = "Что то пошло не так, попробуйте снова. Убедитесь, что вы присылаете текст и/или фотографию не файлом."
+
+            await send_text(context.bot, update.effective_chat.id, text, placeholder)
+
+            return False
+
+    async def get_model_messages(self, bot, messages):
+        # the ids that shared mode merges turns by are not accepted by the API
+        messages = [{"role": message["role"], "content": message["content"]} for message in messages]
+
+        return await self.image_input.resolve_messages(bot, messages)
+
+    async def create_chat_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder, model):
+        if self.stream_responses and placeholder:
+            return await self.stream_chat_response(update, context, placeholder, model)
+
+        messages = await self.get_model_messages(context.bot, context.user_data["messages"])
+        completion = await self.model_client.chat_completion(model, messages)
+
+        response = completion.choices[0].message.content
+
+        await send_response(
+            context.bot,
+            update.effective_chat.id,
+            response,
+            max_messages=self.max_response_messages,
+            placeholder=placeholder
+        )
+
+        return response
     
-    async def handle_image_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def stream_chat_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder, model):
+        editor = StreamingMessageEditor(
+            context.bot,
+            update.effective_chat.id,
+            placeholder,
+            edit_interval=self.stream_edit_interval
+        )
+
+        response = ""
+
+        messages = await self.get_model_messages(context.bot, context.user_data["messages"])
+
+        async for chunk in self.model_client.stream_chat_completion(model, messages):
+            response += chunk
+
+            await editor.append(chunk)
+
+        await editor.finish()
+
+        return response
+
+    async def handle_image_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder=None, reservation=None):
+        """Answers from the response cache or queues an image job, in which case it returns None."""
         try:
             message = update.message.text
 
-            generated_image_data = self.openai_client.images.generate(
-                model=context.user_data["current_model"],
-                prompt=message,
-                n=1,
-                size="1024x1024",
-                quality="standard"
-            )
+            if self.response_cache:
+                cache_key = self.response_cache.make_key(context.user_data["current_model"], message, "1024x1024 standard")
 
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=generated_image_data.data[0].url
-            )
-        except BadRequestError as ex:
-            if ex.code == "content_policy_violation":
-                print(ex)
-                
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Ваш запрос содержит текст, недопустимый системой безопасности openAi"
-                )
+                url = await self.response_cache.get(cache_key)
+
+                if url is not None:
+                    await context.bot.send_document(
+                        chat_id=update.effective_chat.id,
+                        document=url
+                    )
+
+                    return True
+
+            position = await self.image_jobs.submit(context.user_data["current_model"], message, {
+                "user_id": update.effective_user.id,
+                "chat_id": update.effective_chat.id,
+                "message_id": placeholder.message_id if placeholder else None,
+                "unlimited": reservation.unlimited if reservation else True
+            })
+
+            if position > 1:
+                text = "Изображение в очереди: {}. Пришлю его, когда оно будет готово".format(position)
             else:
-                print(ex)
+                text = "Рисую изображение. Пришлю его, когда оно будет готово"
 
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Эта модель распознает только текст"
-                )
+            await send_text(context.bot, update.effective_chat.id, text, placeholder)
+
+            return None
         except Exception as ex:
-            print(ex)
+            metrics.report_error("image", ex)
 
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Эта модель распознает только текст"
-            )
-    
-    async def handle_voice_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+            await send_text(context.bot, update.effective_chat.id, self.get_image_error_text(ex), placeholder)
+
+            return False
+
+    def get_image_error_text(self, ex):
+        if is_openai_error(ex, "BadRequestError") and ex.code == "content_policy_violation":
+            return "Ваш запрос содержит текст, недопустимый системой безопасности openAi"
+
+        if isinstance(ex, CircuitOpenError) or is_transient_error(ex):
+            return MODEL_UNAVAILABLE_TEXT
+
+        return "Эта модель распознает только текст"
+
+    async def deliver_image_job(self, job, url, ex):
+        """Sends the image of a finished job to every request of it and settles their reservations."""
+        bot = self.application.bot
+
+        if ex is not None:
+            metrics.report_error("image", ex)
+        elif self.response_cache:
+            cache_key = self.response_cache.make_key(job["model"], job["prompt"], "1024x1024 standard")
+
+            await self.response_cache.set(cache_key, url, ttl=min(self.response_cache.ttl, IMAGE_URL_TTL))
+
+        for request in job["requests"]:
+            reservation = QuotaReservation(request["user_id"], job["model"], unlimited=request["unlimited"])
+
+            try:
+                if ex is None:
+                    await bot.send_document(chat_id=request["chat_id"], document=url)
+
+                    await self.quota_engine.commit(reservation)
+                else:
+                    text = self.get_image_error_text(ex)
+
+                    if request["message_id"]:
+                        await bot.edit_message_text(chat_id=request["chat_id"], message_id=request["message_id"], text=text)
+                    else:
+                        await bot.send_message(chat_id=request["chat_id"], text=text)
+
+                    # users that are not in memory, or were evicted and are reloaded on their next
+                    # update, only need the refund in the database
+                    user_data = self.application.user_data.get(request["user_id"])
+
+                    if not user_data:
+                        user_data = UserState()
+
+                    await self.quota_engine.refund(reservation, user_data)
+            except Exception as delivery_ex:
+                metrics.report_error("image", delivery_ex)
+
+    async def handle_voice_model_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE, placeholder=None):
         try: 
             file_id = update.message.voice.file_id
 
-            new_file = await context.bot.get_file(file_id)
-
-            random_id = uuid.uuid4()
+            async with self.transcription_semaphore:
+                new_file = await context.bot.get_file(file_id)
 
-            file_name = str(random_id) + "-" + str(update.effective_user.id) + ".mp3"
+                # voice notes stay in memory unless they are larger than the spool threshold
+                with tempfile.SpooledTemporaryFile(max_size=self.voice_spool_threshold) as audio_file:
+                    await new_file.download_to_memory(audio_file)
 
-            await new_file.download_to_drive("voice_messages/" + file_name)
+                    audio_file.seek(0)
 
-            with open("voice_messages/" + file_name, "rb") as audio_file:
-                transcript = self.openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file
-                )
+                    transcript = await self.model_client.transcribe(("voice.ogg", audio_file))
 
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=transcript.text
-            )
+            for index, part in enumerate(split_message(transcript.text)):
+                await send_text(context.bot, update.effective_chat.id, part, placeholder if index == 0 else None)
 
-            os.remove("voice_messages/" + file_name)
+            return True
         except Exception as ex:
-            print(ex)
+            metrics.report_error("voice", ex)
 
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Эта модель принимает только голосовые сообщения"
-            )
+            if isinstance(ex, CircuitOpenError) or is_transient_error(ex):
+                text = MODEL_UNAVAILABLE_TEXT
+            else:
+                text = "Эта модель принимает только голосовые сообщения"
+
+            await send_text(context.bot, update.effective_chat.id, text, placeholder)
+
+            return False
 
     async def chat_request(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
-        await context.bot.send_message(
+        placeholder = await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Обрабатываю запрос..."
         )
 
         current_model = context.user_data["current_model"]
 
-        if context.user_data[current_model] != "Безлимит":
+        tokens = 1
 
-            if context.user_data[current_model] <= 0:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="У вас больше нет запросов на эту модель"
-                )
+        if current_model in CHAT_MODELS:
+            tokens = self.conversation_window.count_tokens(context.user_data["messages"]) + RESPONSE_TOKEN_ESTIMATE
+
+        queued = False
+
+        async def show_queue_position(position):
+            nonlocal queued
+
+            queued = True
+
+            await placeholder.edit_text(text="Вы в очереди: {}. Запрос будет обработан автоматически".format(position))
+
+        try:
+            ticket = await self.admission_controller.admit(
+                update.effective_user.id,
+                current_model,
+                tokens=tokens,
+                on_queued=show_queue_position
+            )
+        except AdmissionRejected as ex:
+            if ex.reason == "user_rate_limit":
+                text = "Слишком много запросов. Подождите немного и попробуйте снова"
+            else:
+                text = "Сейчас слишком много запросов к этой модели. Попробуйте позже"
+
+            await placeholder.edit_text(text=text)
+
+            return
+
+        try:
+            if queued:
+                await placeholder.edit_text(text="Обрабатываю запрос...")
+
+            reservation = await self.quota_engine.reserve(update.effective_user.id, current_model, context.user_data)
+
+            if reservation == None:
+                QUOTA_REJECTIONS.inc(model=current_model)
+
+                await placeholder.edit_text(text="У вас больше нет запросов на эту модель")
 
                 return
-            
-            context.user_data[current_model] -= 1
 
-        chat_models = ["gpt-4o-mini", "gpt-4o"]
+            if current_model in CHAT_MODELS:
+                succeeded = await self.handle_chat_model_request(update, context, placeholder)
+            elif current_model == "dall-e-3":
+                succeeded = await self.handle_image_model_request(update, context, placeholder, reservation)
+            else:
+                succeeded = await self.handle_voice_model_request(update, context, placeholder)
 
-        if current_model in chat_models:
-            await self.handle_chat_model_request(update, context)
-        elif current_model == "dall-e-3":
-            await self.handle_image_model_request(update, context)
-        else:
-            await self.handle_voice_model_request(update, context)
+            if succeeded is None:
+                # the image job settles the reservation once it is done
+                return
+
+            if succeeded:
+                await self.quota_engine.commit(reservation)
+            else:
+                await self.quota_engine.refund(reservation, context.user_data)
+        finally:
+            ticket.release()
 
     async def choose_premium(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         keyboard = [
             [InlineKeyboardButton("Лайт 499 руб.", callback_data="Lite")],
@@ -311,7 +630,7 @@ class TelegramBot():
         )
     
     async def handle_choose_premium_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
         
         query = update.callback_query
 
@@ -368,47 +687,45 @@ class TelegramBot():
     async def answer_pre_checkout_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.pre_checkout_query
 
-        invoice_payloads = ["Bot-Subscription-Lite", "Bot-Subscription-Smart", "Bot-Subscription-Pro"]
-
-        if query.invoice_payload not in invoice_payloads:
+        if get_plan(query.invoice_payload) is None:
             await query.answer(ok=False, error_message="Something went wrong")
         else:
-            context.user_data["chosen_premium"] = query.invoice_payload.split("-")[2]
             await query.answer(ok=True)
     
     async def successful_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        if context.user_data["chosen_premium"] == "Lite":
-            context.user_data["gpt-4o-mini"] = "Безлимит"
-            context.user_data["gpt-4o"] = 25
-            context.user_data["dall-e-3"] = 25
-            context.user_data["whisper"] = "Безлимит"
-            context.user_data["subscription"] = "Lite"
-        elif context.user_data["chosen_premium"] == "Smart":
-            context.user_data["gpt-4o-mini"] = "Безлимит"
-            context.user_data["gpt-4o"] = 50
-            context.user_data["dall-e-3"] = 50
-            context.user_data["whisper"] = "Безлимит"
-            context.user_data["subscription"] = "Smart"
-        else:
-            context.user_data["gpt-4o-mini"] = "Безлимит"
-            context.user_data["gpt-4o"] = 100
-            context.user_data["dall-e-3"] = 50
-            context.user_data["whisper"] = "Безлимит"
-            context.user_data["subscription"] = "Pro"
-        
-        current_date_list = datetime.now().date().isoformat().split("-")
-
-        if current_date_list[1] == "12":
-            context.user_data["subscription_expiry_date"] = str(int(current_date_list[0]) + 1) + "-01-" + current_date_list[2]
-        else:
-            month = str(int(current_date_list[1]) + 1)
+        payment = update.message.successful_payment
+
+        # the plan comes from the payment itself and the ledger entry is written before it is granted
+        for attempt in range(PAYMENT_RECORD_ATTEMPTS):
+            try:
+                entry = await self.payment_ledger.record(update.effective_user.id, payment, self.quota_calendar.today())
+
+                break
+            except Exception as ex:
+                if isinstance(ex, PyMongoError) and attempt + 1 < PAYMENT_RECORD_ATTEMPTS:
+                    await asyncio.sleep(PAYMENT_RECORD_BASE_DELAY * 2 ** attempt)
+
+                    continue
+
+                # the charge ids are all that is left to find the payment and grant it by hand
+                print("Payment of user {} was not recorded: telegram charge {}, provider charge {}, payload {}, {} {}".format(
+                    update.effective_user.id,
+                    payment.telegram_payment_charge_id,
+                    payment.provider_payment_charge_id,
+                    payment.invoice_payload,
+                    payment.total_amount,
+                    payment.currency
+                ))
+                metrics.report_error("payment_record", ex)
 
-            if len(month) == 1:
-                month = "0" + month
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=PAYMENT_NOT_RECORDED_TEXT.format(payment.telegram_payment_charge_id)
+                )
 
-            context.user_data["subscription_expiry_date"] = current_date_list[0] + "-" + month + "-" + current_date_list[2]
+                return
 
-        context.user_data.pop("chosen_premium")
+        await self.payment_ledger.apply(entry, context.user_data)
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -416,7 +733,7 @@ class TelegramBot():
         )
 
     async def handle_go_back_to_premium(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         query = update.callback_query
 
@@ -439,9 +756,11 @@ class TelegramBot():
         )
 
     async def view_account(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
+
+        conversation_stats = self.conversation_window.get_stats(context.user_data["messages"])
 
-        text = self.text_generator.get_account_text(context.user_data)
+        text = self.text_generator.get_account_text(context.user_data, conversation_stats)
         
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -449,7 +768,7 @@ class TelegramBot():
         )
 
     async def choose_model(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         keyboard = [
             [InlineKeyboardButton("gpt-4o-mini", callback_data="gpt-4o-mini")],
@@ -467,7 +786,7 @@ class TelegramBot():
         )
 
     async def handle_choose_model_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        self.check_data(update, context)
+        await self.check_data(update, context)
 
         query = update.callback_query
 
@@ -509,10 +828,200 @@ class TelegramBot():
         self.application.add_handler(go_back_to_premium_handler)
         self.application.add_handler(pre_checkout_query_handler)
         self.application.add_handler(successful_payment_handler)
+
+        for handler in self.application.handlers[0]:
+            handler.callback = self.instrument_handler(handler.callback)
+
+        # with several workers the user data is written after every update so other workers see it
+        if self.persistence.shared:
+            self.application.add_handler(TypeHandler(Update, self.write_shared_user_data), group=1)
+
+    def schedule_quota_reset(self):
+        job_queue = self.application.job_queue
+
+        if job_queue is None:
+            print("JobQueue is not available, daily quotas are reset per user")
+
+            return
+
+        job_queue.run_daily(self.reset_daily_quotas, time(0, 0, tzinfo=self.quota_calendar.timezone), name="reset_daily_quotas")
+        # catches up on a reset missed while the bot was down
+        job_queue.run_once(self.reset_daily_quotas, 0, name="reset_daily_quotas_on_start")
+
+    async def reset_daily_quotas(self, context: ContextTypes.DEFAULT_TYPE):
+        await reset_daily_quotas(self.quota_engine, self.quota_calendar)
+
+    def instrument_handler(self, callback):
+        async def instrumented_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            start = time_module.perf_counter()
+
+            try:
+                return await callback(update, context)
+            except Exception as ex:
+                metrics.report_error(callback.__name__, ex)
+
+                raise
+            finally:
+                model = context.user_data.get("current_model") if context.user_data is not None else None
+
+                HANDLER_DURATION.observe(time_module.perf_counter() - start, handler=callback.__name__, model=model or "")
+
+        return instrumented_callback
+
+    async def post_init(self, application):
+        # workers sharing a fresh database would insert a user twice before its unique index exists
+        if self.persistence.shared:
+            await self.run_until_passed([lambda: asyncio.to_thread(self.create_indexes)])
+
+        self.boot_task = asyncio.create_task(self.boot())
+
+        self.image_jobs.start()
+
+        if self.model_client.router:
+            self.model_client.router.start()
+
+        await self.start_metrics()
+
+    async def post_shutdown(self, application):
+        if self.boot_task:
+            self.boot_task.cancel()
+
+            await asyncio.gather(self.boot_task, return_exceptions=True)
+
+            self.boot_task = None
+
+        await self.image_jobs.stop()
+
+        if self.model_client.router:
+            await self.model_client.router.stop()
+
+        await self.stop_metrics()
+
+    async def start_metrics(self):
+        metrics_port = os.environ.get("METRICS_PORT")
+
+        if not metrics_port:
+            return
+
+        metrics.REGISTRY.add_collector("admission", self.admission_controller.get_stats)
+        metrics.REGISTRY.add_collector("model_client", self.model_client.get_stats)
+        metrics.REGISTRY.add_collector("image_input", self.image_input.get_stats)
+        metrics.REGISTRY.add_collector("image_jobs", self.image_jobs.get_stats)
+
+        if self.model_client.router:
+            metrics.REGISTRY.add_collector("model_router", self.model_client.router.get_stats)
+
+        if self.response_cache:
+            metrics.REGISTRY.add_collector("response_cache", self.response_cache.get_stats)
+
+        self.metrics_server = metrics.MetricsServer(
+            listen=os.environ.get("METRICS_LISTEN", "127.0.0.1"),
+            port=int(metrics_port),
+            profiler_enabled=os.environ.get("METRICS_PROFILER") == "1",
+            ready=self.is_ready
+        )
+
+        await self.metrics_server.start()
+
+    async def stop_metrics(self):
+        if self.metrics_server:
+            await self.metrics_server.stop()
+
+    async def write_shared_user_data(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user and len(context.user_data) > 0:
+            await self.persistence.update_user_data(update.effective_user.id, deepcopy(context.user_data))
     
-    def run(self):
-        self.application.run_polling()
+    def run(self, mode="polling", reuse_port=False):
+        if mode == "webhook":
+            # aiohttp is only imported in webhook mode
+            from webhook import WebhookServer
+
+            webhook_server = WebhookServer(
+                self.application,
+                listen=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+                port=int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", 8443))),
+                path=os.environ.get("WEBHOOK_PATH", "/telegram"),
+                secret_token=os.environ.get("WEBHOOK_SECRET_TOKEN"),
+                webhook_url=os.environ.get("WEBHOOK_URL"),
+                reuse_port=reuse_port
+            )
 
-if __name__ == "__main__":
+            webhook_server.run()
+        else:
+            self.application.run_polling()
+
+def get_local_timezone(environ):
+    """The timezone of the server with its DST rules, unlike the fixed offset of astimezone()."""
+    name = environ.get("TZ", "").lstrip(":")
+
+    if name:
+        return ZoneInfo(name)
+
+    try:
+        with open("/etc/localtime", "rb") as file:
+            return ZoneInfo.from_file(file, key="localtime")
+    except OSError:
+        return ZoneInfo("UTC")
+
+def create_quota_calendar(environ):
+    timezone = environ.get("QUOTA_TIMEZONE")
+
+    return QuotaCalendar(ZoneInfo(timezone) if timezone else get_local_timezone(environ))
+
+async def reset_daily_quotas(quota_engine, quota_calendar):
+    try:
+        # before the reset, which overwrites the free quota that recovered credits would go to
+        recovered = await quota_engine.recover_reservations()
+        downgraded, refilled = await quota_engine.reset_daily_quotas(quota_calendar.today())
+
+        print("Daily quota reset: {} subscriptions expired, {} free quotas refilled, {} reserved credits recovered".format(downgraded, refilled, recovered))
+    except Exception as ex:
+        metrics.report_error("quota_reset", ex)
+
+def run_quota_reset():
+    load_dotenv()
+
+    mongo_client = create_mongo_client(os.environ)
+
+    create_user_indexes(mongo_client.user_database)
+
+    quota_engine = QuotaEngine(
+        mongo_client.user_database.users,
+        reservation_timeout=float(os.environ.get("QUOTA_RESERVATION_TIMEOUT", 3600))
+    )
+
+    asyncio.run(reset_daily_quotas(quota_engine, create_quota_calendar(os.environ)))
+
+def run_worker(mode, reuse_port=False):
     telegram_bot = TelegramBot()
-    telegram_bot.run()
\ No newline at end of file
+    telegram_bot.run(mode, reuse_port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.environ.get("BOT_MODE", "polling"))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("BOT_WORKERS", 1)))
+    parser.add_argument("--reset-quotas", action="store_true", help="reset daily quotas once and exit, e.g. from cron")
+
+    args = parser.parse_args()
+
+    if args.reset_quotas:
+        run_quota_reset()
+    elif args.workers > 1:
+        if args.mode != "webhook":
+            parser.error("several workers can only receive updates in webhook mode")
+
+        # the workers share one port and keep user data consistent through MongoDB
+        os.environ["PERSISTENCE_SHARED"] = "1"
+
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(args.mode, True))
+            for _ in range(args.workers)
+        ]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+    else:
+        run_worker(args.mode)
\ No newline at end of file
@@ -1,7 +1,16 @@
+from user_state import UNLIMITED, LEGACY_UNLIMITED
+
+
 class TextGenerator():
     def __init__(self):
         pass
 
+    def format_value(self, value):
+        if value == UNLIMITED or value is None:
+            return LEGACY_UNLIMITED
+
+        return value
+
     def get_welcome_text(self):
         return """
     Привет! 😊
@@ -50,7 +59,7 @@ class TextGenerator():
 Для тех, кто хочет максимум возможностей. Безлимитный доступ к gpt-4o-mini и whisper, 100 запросов к gpt4-o, 100 запросов dall-e-3.
     """
 
-    def get_account_text(self, user: dict):
+    def get_account_text(self, user: dict, conversation_stats: dict):
         return """
     Подписка: {}
 Дата истечения подписки: {}
@@ -61,4 +70,6 @@ GPT-4o-mini: {}
 GPT-4o: {}
 DALL-E 3: {}
 WHISPER: {}
-    """.format(user.get("subscription"), user.get("subscription_expiry_date"), user.get("current_model"), user.get("gpt-4o-mini"), user.get("gpt-4o"), user.get("dall-e-3"), user.get("whisper"))
\ No newline at end of file
+
+Текущий чат: {} сообщений, ~{} токенов, ~{:.1f} КБ памяти
+    """.format(user.get("subscription"), self.format_value(user.get("subscription_expiry_date")), user.get("current_model"), *[self.format_value(user.get(field)) for field in ["gpt-4o-mini", "gpt-4o", "dall-e-3", "whisper"]], conversation_stats["messages"], conversation_stats["tokens"], conversation_stats["memory"] / 1024)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently and updates of the same user in order.
+
+    The per-user lock is taken before a worker slot, so a user with a long backlog
+    does not occupy slots that other users could run in.
+
+    Telegram sends every photo of an album as its own update. If media_group_wait is
+    set, the first update of an album waits that long for the others under the lock of
+    its user, so later updates of the user stay behind it. The others are not processed
+    themselves; handlers get all messages of the album from get_media_group. Photos that
+    arrive once the handler of the album started are processed as updates of their own.
+    """
+
+    def __init__(self, max_concurrent_updates: int, media_group_wait=0):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = {}
+        self.user_waiters = {}
+        self.media_group_wait = media_group_wait
+        self.media_groups = {}
+        self.collecting_media_groups = set()
+
+    def get_user_id(self, update):
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+
+        return None
+
+    def get_user_lock(self, user_id):
+        if user_id not in self.user_locks:
+            self.user_locks[user_id] = asyncio.Lock()
+            self.user_waiters[user_id] = 0
+
+        return self.user_locks[user_id]
+
+    def is_user_busy(self, user_id):
+        # a user has a lock while one of its updates is waiting or running
+        return user_id in self.user_locks
+
+    def get_media_group(self, message):
+        media_group = self.media_groups.get(message.media_group_id) if message.media_group_id else None
+
+        # a photo that came too late for its album is answered on its own
+        if media_group and media_group[0].message_id == message.message_id:
+            return media_group
+
+        return [message]
+
+    async def wait_for_media_group(self, media_group_id):
+        if media_group_id is None:
+            return
+
+        await asyncio.sleep(self.media_group_wait)
+
+        self.collecting_media_groups.discard(media_group_id)
+
+    async def process_update(self, update, coroutine):
+        media_group_id = update.message.media_group_id if isinstance(update, Update) and update.message else None
+
+        if media_group_id is None or self.media_group_wait <= 0:
+            await self.process_user_update(update, coroutine)
+
+            return
+
+        if media_group_id in self.collecting_media_groups:
+            self.media_groups[media_group_id].append(update.message)
+
+            # the album is answered by the update of its first message
+            coroutine.close()
+
+            return
+
+        if media_group_id in self.media_groups:
+            await self.process_user_update(update, coroutine)
+
+            return
+
+        self.media_groups[media_group_id] = [update.message]
+        self.collecting_media_groups.add(media_group_id)
+
+        try:
+            await self.process_user_update(update, coroutine, media_group_id)
+        finally:
+            self.collecting_media_groups.discard(media_group_id)
+            self.media_groups.pop(media_group_id, None)
+
+    async def process_user_update(self, update, coroutine, media_group_id=None):
+        user_id = self.get_user_id(update)
+
+        if user_id is None:
+            await self.wait_for_media_group(media_group_id)
+            await super().process_update(update, coroutine)
+
+            return
+
+        lock = self.get_user_lock(user_id)
+
+        self.user_waiters[user_id] += 1
+
+        try:
+            async with lock:
+                await self.wait_for_media_group(media_group_id)
+                await super().process_update(update, coroutine)
+        finally:
+            self.user_waiters[user_id] -= 1
+
+            if self.user_waiters[user_id] == 0:
+                self.user_locks.pop(user_id)
+                self.user_waiters.pop(user_id)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,220 @@
+import sys
+from collections.abc import MutableMapping
+from datetime import date, datetime
+from model_enum import Enum
+
+UNLIMITED = -1
+LEGACY_UNLIMITED = "Безлимит"
+
+QUOTA_FIELDS = [Enum.GPT4O_MINI.value, Enum.GPT4O.value, Enum.DALLE3.value, Enum.WHISPER.value]
+DATE_FIELDS = ["last_free_request_date", "subscription_expiry_date"]
+
+# user_data keys and the slots that hold them
+FIELD_SLOTS = {
+    "current_model": "current_model",
+    Enum.GPT4O_MINI.value: "gpt_4o_mini",
+    Enum.GPT4O.value: "gpt_4o",
+    Enum.DALLE3.value: "dall_e_3",
+    Enum.WHISPER.value: "whisper",
+    "subscription": "subscription",
+    "last_free_request_date": "last_free_request_date",
+    "subscription_expiry_date": "subscription_expiry_date",
+    "messages": "messages",
+    "chosen_premium": "chosen_premium"
+}
+
+# fields of the users collection, messages live in the conversations collection
+PERSISTENT_FIELDS = [field for field in FIELD_SLOTS if field not in ["messages", "chosen_premium"]]
+
+FIELD_BITS = {field: 1 << index for index, field in enumerate(FIELD_SLOTS)}
+# keys outside FIELD_SLOTS share one bit and are always written together
+EXTRA_FIELDS_BIT = 1 << len(FIELD_SLOTS)
+
+
+def parse_bson_value(field, value):
+    """Converts a value of the users collection, including the old string formats, to its type in UserState."""
+    if field in QUOTA_FIELDS:
+        return UNLIMITED if value == LEGACY_UNLIMITED else value
+
+    # the few distinct model and subscription names are shared by all users
+    if isinstance(value, str) and field in ["current_model", "subscription"]:
+        return sys.intern(value)
+
+    if field in DATE_FIELDS:
+        if value == LEGACY_UNLIMITED:
+            return None
+
+        if isinstance(value, datetime):
+            return value.date()
+
+        if isinstance(value, str):
+            return date.fromisoformat(value)
+
+    return value
+
+
+def to_bson_value(value):
+    # BSON has no date type, so dates are stored as midnight
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+
+    return value
+
+
+def fields_to_bson(fields: dict):
+    return {field: to_bson_value(value) for field, value in fields.items()}
+
+
+class UserState(MutableMapping):
+    """Compact state of one user, used as context.user_data.
+
+    Quotas are ints with UNLIMITED for unlimited requests and dates are date objects,
+    None meaning a subscription without expiry. Fields are read and written with the
+    same keys as the users collection. Every write marks the field dirty, so persistence
+    only writes changed fields; loading from BSON leaves the state clean.
+
+    Keys other than the known fields are kept in a dict that is only created when needed.
+    Dirty fields are bits of an int, which costs nothing while a user is clean.
+    """
+
+    __slots__ = tuple(FIELD_SLOTS.values()) + ("extra_fields", "dirty_mask")
+
+    def __init__(self, fields=None):
+        self.extra_fields = None
+        self.dirty_mask = 0
+
+        if fields:
+            self.update(fields)
+
+    @classmethod
+    def create_new(cls, today):
+        return cls({
+            "current_model": Enum.GPT4O_MINI.value,
+            Enum.GPT4O_MINI.value: 5,
+            Enum.GPT4O.value: 0,
+            Enum.DALLE3.value: 0,
+            Enum.WHISPER.value: 0,
+            "subscription": Enum.FREE.value,
+            "last_free_request_date": today,
+            "subscription_expiry_date": None
+        })
+
+    @classmethod
+    def from_bson(cls, document: dict):
+        state = cls()
+        state.load_bson(document)
+
+        return state
+
+    def load_bson(self, document: dict, fields=PERSISTENT_FIELDS):
+        for field in fields:
+            value = document.get(field)
+
+            if field == "subscription" and value is None:
+                value = Enum.FREE.value
+
+            setattr(self, FIELD_SLOTS[field], parse_bson_value(field, value))
+            self.dirty_mask &= ~FIELD_BITS[field]
+
+    def to_bson(self, dirty_only=False):
+        document = {}
+
+        for field in PERSISTENT_FIELDS:
+            slot = FIELD_SLOTS[field]
+
+            if (not dirty_only or self.dirty_mask & FIELD_BITS[field]) and hasattr(self, slot):
+                document[field] = to_bson_value(getattr(self, slot))
+
+        if self.extra_fields and (not dirty_only or self.dirty_mask & EXTRA_FIELDS_BIT):
+            document.update(self.extra_fields)
+
+        return document
+
+    def mark_clean(self, written_state):
+        """Clears the dirty flags of fields that still have the value written from written_state."""
+        for field, bit in FIELD_BITS.items():
+            if written_state.dirty_mask & bit and self.get(field) == written_state.get(field):
+                self.dirty_mask &= ~bit
+
+        if written_state.dirty_mask & EXTRA_FIELDS_BIT and self.extra_fields == written_state.extra_fields:
+            self.dirty_mask &= ~EXTRA_FIELDS_BIT
+
+    def copy(self):
+        state = UserState()
+
+        for slot in FIELD_SLOTS.values():
+            if hasattr(self, slot):
+                setattr(state, slot, getattr(self, slot))
+
+        state.extra_fields = dict(self.extra_fields) if self.extra_fields else None
+        state.dirty_mask = self.dirty_mask
+
+        return state
+
+    def __getitem__(self, key):
+        slot = FIELD_SLOTS.get(key)
+
+        try:
+            if slot is None:
+                return self.extra_fields[key]
+
+            return getattr(self, slot)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = FIELD_SLOTS.get(key)
+
+        if slot is None:
+            if self.extra_fields is None:
+                self.extra_fields = {}
+
+            self.extra_fields[key] = value
+            self.dirty_mask |= EXTRA_FIELDS_BIT
+        else:
+            setattr(self, slot, value)
+            self.dirty_mask |= FIELD_BITS[key]
+
+    def __delitem__(self, key):
+        slot = FIELD_SLOTS.get(key)
+
+        try:
+            if slot is None:
+                del self.extra_fields[key]
+            else:
+                delattr(self, slot)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+        if slot is not None:
+            self.dirty_mask &= ~FIELD_BITS[key]
+
+    def __contains__(self, key):
+        slot = FIELD_SLOTS.get(key)
+
+        if slot is None:
+            return self.extra_fields is not None and key in self.extra_fields
+
+        return hasattr(self, slot)
+
+    def __iter__(self):
+        for field, slot in FIELD_SLOTS.items():
+            if hasattr(self, slot):
+                yield field
+
+        if self.extra_fields:
+            yield from list(self.extra_fields)
+
+    def __len__(self):
+        return sum(1 for slot in FIELD_SLOTS.values() if hasattr(self, slot)) + len(self.extra_fields or ())
+
+    def clear(self):
+        for slot in FIELD_SLOTS.values():
+            if hasattr(self, slot):
+                delattr(self, slot)
+
+        self.extra_fields = None
+        self.dirty_mask = 0
+
+    def __repr__(self):
+        return "UserState({})".format(dict(self.items()))
@@ -0,0 +1,93 @@
+import asyncio
+import hmac
+import signal
+from aiohttp import web
+from telegram import Update
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer():
+    """Receives updates from Telegram on an aiohttp server and feeds them to the application."""
+
+    def __init__(self, application, listen="0.0.0.0", port=8443, path="/telegram", secret_token=None, webhook_url=None, reuse_port=False):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.webhook_url = webhook_url
+        self.reuse_port = reuse_port
+        self.stop_event = asyncio.Event()
+        self.web_application = web.Application()
+        self.web_application.router.add_post(self.path, self.handle_update)
+
+    async def handle_update(self, request):
+        # compared in constant time, so the token can not be guessed from response times
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, "").encode(), self.secret_token.encode()):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        # a body that is JSON but not an update would be redelivered forever after a 500
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception:
+            return web.Response(status=400)
+
+        await self.application.update_queue.put(update)
+
+        return web.Response()
+
+    async def start(self):
+        await self.application.initialize()
+
+        # run_polling calls these hooks itself, this server has to do it
+        if self.application.post_init:
+            await self.application.post_init(self.application)
+
+        await self.application.start()
+
+        if self.webhook_url:
+            await self.application.bot.set_webhook(
+                url=self.webhook_url,
+                secret_token=self.secret_token,
+                allowed_updates=Update.ALL_TYPES
+            )
+
+        self.runner = web.AppRunner(self.web_application)
+
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, self.listen, self.port, reuse_port=self.reuse_port)
+
+        await site.start()
+
+        print("Listening for webhook updates on {}:{}{}".format(self.listen, self.port, self.path))
+
+    async def stop(self):
+        await self.runner.cleanup()
+        await self.application.stop()
+        await self.application.shutdown()
+
+        if self.application.post_shutdown:
+            await self.application.post_shutdown(self.application)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+
+        for signal_number in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signal_number, self.stop_event.set)
+
+        await self.start()
+
+        try:
+            await self.stop_event.wait()
+        finally:
+            await self.stop()
+
+    def run(self):
+        asyncio.run(self.serve())